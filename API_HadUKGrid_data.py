@@ -16,26 +16,32 @@ __maintainer__ = "Alexis Hrysiewicz"
 __status__ = "Production"
 __date__ = "Aug. 2022"
 
-print("****************************************************************************************************************************")
-print("API_HadUKGrid_data.py: Script to download the weather data from HadUK-Grid")
-print("****************************************************************************************************************************")
-
 ###########################################################################
 # Python packages
 ###########################################################################
+# cf, matplotlib, pyarrow, scipy and pyshp are imported by the functions which need
+# them, so that the module can be imported and the options checked without them.
 import sys
 import os
 from tqdm import tqdm
-import cf
-from matplotlib import path
-import matplotlib.pyplot as plt
-from matplotlib.dates import YearLocator, MonthLocator, DateFormatter
 import numpy as np
-from datetime import datetime, timezone, timedelta
+from datetime import datetime, timedelta
 from calendar import monthrange
 import optparse
-from ftplib import FTP
-import pandas as pd
+import json
+import csv
+import hashlib
+import re
+import warnings
+import posixpath
+from time import time as epoch_now
+from ftplib import FTP, error_perm, all_errors as ftp_errors
+import threading
+import queue
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from time import perf_counter
+import pickle
+import contextlib
 
 cur_dir = os.getcwd()
 
@@ -43,10 +49,16 @@ cur_dir = os.getcwd()
 # Server Information 
 ###########################################################################
 ver=''
+ftp_host='ftp.ceda.ac.uk'
+ftp_port=21
+ftp_root='badc/ukmo-hadobs/data/insitu/MOHC/HadOBS/HadUK-Grid'
 
 ###########################################################################
 # Definition of functions and classes
 ###########################################################################
+class HadUKGridError(Exception):
+    pass
+
 class OptionParser (optparse.OptionParser):
     def check_required(self, opt):
         option = self.get_option(opt)
@@ -61,15 +73,1154 @@ def date_range_list(start_date, end_date):
         curr_date += timedelta(days=1)
     return date_list
 
+def read_json(filename, default):
+    if os.path.exists(filename):
+        try:
+            with open(filename, 'r') as fp:
+                return json.load(fp)
+        except (OSError, ValueError):
+            print("WARNING: %s is not readable and will be rebuilt" % (filename))
+    return default
+
+def write_json(filename, obj):
+    # Write to a temporary name first so that readers never see a partial file
+    tmpname = '%s.%d.tmp' % (filename, os.getpid())
+    with open(tmpname, 'w') as fp:
+        json.dump(obj, fp, indent=1)
+    os.replace(tmpname, filename)
+
+def peak_rss():
+    # High-water mark of the resident memory in MB of the process and of its finished
+    # children (the read workers), None where the resource module does not exist
+    try:
+        import resource
+    except ImportError:
+        return None, None
+    scale = 1e6 if sys.platform == 'darwin' else 1e3
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/scale, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss/scale
+
+class Metrics:
+    # Instrumentation of a run: wall time, number of calls and bytes of each stage
+    # (catalog, download, read, reduce, write...), counters and peak resident memory,
+    # written as a JSON or Prometheus text report. The stages run in the read workers
+    # are sent back with their results and added with record().
+    def __init__(self):
+        self.t0 = perf_counter()
+        self.lock = threading.Lock()
+        self.stages = {}
+        self.counters = {}
+        self.extra = {}
+
+    def record(self, stage, seconds, nbytes=0, calls=1):
+        with self.lock:
+            entry = self.stages.setdefault(stage, {'calls': 0, 'seconds': 0., 'max_seconds': 0., 'bytes': 0})
+            entry['calls'] += calls
+            entry['seconds'] += seconds
+            entry['max_seconds'] = max(entry['max_seconds'], seconds)
+            entry['bytes'] += nbytes
+            entry['peak_rss_mb'] = peak_rss()[0]
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        # Time a block as one call of a stage
+        t0 = perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, perf_counter() - t0)
+
+    def record_extraction(self, timings):
+        # Timings of extract_file
+        if timings['cached']:
+            self.count('result_cache_hits')
+        else:
+            self.record('read', timings['read'], timings['bytes'])
+            self.record('reduce', timings['reduce'])
+
+    def count(self, name, value=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def report(self):
+        rss, children = peak_rss()
+        stages = {}
+        for name, entry in self.stages.items():
+            stages[name] = dict(entry, rate_mb_s=entry['bytes']/1e6/entry['seconds'] if entry['bytes'] > 0 and entry['seconds'] > 0 else None)
+        return dict({'wall_seconds': perf_counter() - self.t0, 'peak_rss_mb': rss, 'peak_rss_children_mb': children, 
+            'stages': stages, 'counters': dict(self.counters)}, **self.extra)
+
+    def prometheus(self):
+        # Prometheus text exposition format (gauges and counters named hadukgrid_*)
+        report = self.report()
+        lines = []
+        def metric(name, kind, help, samples):
+            name = name + '_total' if kind == 'counter' else name
+            lines.extend(['# HELP hadukgrid_%s %s' % (name, help), '# TYPE hadukgrid_%s %s' % (name, kind)])
+            for labels, value in samples:
+                if value is not None:
+                    lines.append('hadukgrid_%s%s %s' % (name, '{%s}' % (','.join('%s="%s"' % kv for kv in labels)) if labels else '', repr(float(value))))
+        metric('run_seconds', 'gauge', 'Wall time of the run.', [((), report['wall_seconds'])])
+        if 'status' in report:
+            metric('run_success', 'gauge', 'Whether the run succeeded.', [((), report['status'] == 'success')])
+        metric('peak_rss_bytes', 'gauge', 'Peak resident memory of the process.', [((), report['peak_rss_mb'] and report['peak_rss_mb']*1e6)])
+        metric('peak_rss_children_bytes', 'gauge', 'Peak resident memory of the read workers.', [((), report['peak_rss_children_mb'] and report['peak_rss_children_mb']*1e6)])
+        for key, kind, help in [('seconds', 'counter', 'Total wall time of the stage.'), ('max_seconds', 'gauge', 'Longest call of the stage.'), 
+                ('calls', 'counter', 'Number of calls of the stage.'), ('bytes', 'counter', 'Bytes processed by the stage.'), 
+                ('rate_mb_s', 'gauge', 'Transfer rate of the stage in MB/s.')]:
+            metric('stage_%s' % (key), kind, help, [((('stage', name),), entry[key]) for name, entry in sorted(report['stages'].items())])
+        metric('events', 'counter', 'Counters of the run.', [((('name', name),), value) for name, value in sorted(report['counters'].items())])
+        return '\n'.join(lines) + '\n'
+
+    def write(self, filename):
+        # Prometheus text for a .prom file, JSON otherwise
+        if filename.endswith('.prom'):
+            tmpname = '%s.%d.tmp' % (filename, os.getpid())
+            with open(tmpname, 'w') as fp:
+                fp.write(self.prometheus())
+            os.replace(tmpname, filename)
+        else:
+            write_json(filename, self.report())
+
+def decode_time(values, units, calendar='standard'):
+    # CF time values "<unit> since <reference>" to datetime64[s], vectorized. HadUK-Grid
+    # uses the gregorian calendar; other calendars are decoded by cf one date at a time.
+    seconds = {'second': 1, 'seconds': 1, 's': 1, 'sec': 1, 'minute': 60, 'minutes': 60, 'min': 60, 
+        'hour': 3600, 'hours': 3600, 'h': 3600, 'hr': 3600, 'day': 86400, 'days': 86400, 'd': 86400}
+    match = re.match(r'\s*(\w+)\s+since\s+(\d+)-(\d+)-(\d+)(?:[T\s]+(\d+):(\d+)(?::(\d+(?:\.\d*)?))?)?', units)
+    if match is None or match.group(1).lower() not in seconds or calendar not in ['standard', 'gregorian', 'proleptic_gregorian']:
+        return None
+    hh, mm, ss = [float(v) if v is not None else 0 for v in match.group(5, 6, 7)]
+    reference = np.datetime64('%04d-%02d-%02dT%02d:%02d:%02d' % (int(match.group(2)), int(match.group(3)), int(match.group(4)), hh, mm, ss), 's')
+    offsets = np.rint(np.asarray(values, dtype=float)*seconds[match.group(1).lower()]).astype(np.int64)
+    return reference + offsets.astype('timedelta64[s]')
+
+def field_dates(f):
+    # Dates of the time steps of a field, read from the time coordinate only
+    t = f.constructs('time').value()
+    dates = decode_time(t.array.flatten(), str(t.units), t.get_property('calendar', 'standard'))
+    if dates is None:
+        dates = np.array(['%04d-%02d-%02dT%02d:%02d:%02d' % (d.year, d.month, min(d.day, monthrange(d.year, d.month)[1]), d.hour, d.minute, d.second) for d in t.datetime_array.flatten()], dtype='datetime64[s]')
+    return dates
+
+def ftp_connect(host, port, username, password, directory=''):
+    ftp = FTP()
+    ftp.connect(host, port)
+    ftp.encoding = "utf-8"
+    ftp.login(user=username, passwd=password)
+    if directory:
+        ftp.cwd(directory)
+    return ftp
+
+def check_target(tid, kind, coords):
+    if kind == 'point':
+        if not (-90 <= coords[0] <= 90) or not (-180 <= coords[1] <= 180):
+            raise ValueError("target %s: incorrect point [lat,lon]" % (tid))
+    elif kind == 'box':
+        if not (-90 <= coords[0] <= 90) or not (-90 <= coords[1] <= 90) or not (-180 <= coords[2] <= 180) or not (-180 <= coords[3] <= 180):
+            raise ValueError("target %s: incorrect box [S,N,W,E]" % (tid))
+        if coords[2] >= coords[3] or coords[0] >= coords[1]:
+            raise ValueError("target %s: incorrect box [S,N,W,E]" % (tid))
+    else:
+        for ring in [ring for poly in coords for ring in poly]:
+            ring = np.asarray(ring)
+            if len(ring) < 3 or np.any(np.abs(ring[:,0]) > 180) or np.any(np.abs(ring[:,1]) > 90):
+                raise ValueError("target %s: incorrect polygon (lon/lat coordinates are expected)" % (tid))
+    return (tid, kind, coords)
+
+def geometry_target(tid, geometry):
+    # Point, Polygon or MultiPolygon GeoJSON geometry to a target. A polygon target is a
+    # list of polygons, each one a list of rings [[lon,lat], ...] (exterior ring first).
+    if geometry['type'] == 'Point':
+        return check_target(tid, 'point', [float(geometry['coordinates'][1]), float(geometry['coordinates'][0])])
+    elif geometry['type'] in ['Polygon', 'MultiPolygon']:
+        polygons = [geometry['coordinates']] if geometry['type'] == 'Polygon' else geometry['coordinates']
+        polygons = [[np.asarray(ring, dtype=float)[:,:2].tolist() for ring in poly] for poly in polygons]
+        return check_target(tid, 'polygon', polygons)
+    else:
+        raise ValueError("feature %s: unsupported geometry %s" % (tid, geometry['type']))
+
+def read_features(filename):
+    # Targets of a GeoJSON file or of a shapefile (lon/lat coordinates)
+    targets = []
+    if filename.lower().endswith('.shp'):
+        try:
+            import shapefile
+        except ImportError:
+            raise ValueError("the pyshp package is needed to read a shapefile")
+        sf = shapefile.Reader(filename)
+        fields = [fi[0] for fi in sf.fields[1:]]
+        for k, sr in enumerate(sf.shapeRecords()):
+            properties = dict(zip(fields, sr.record))
+            tid = str(properties.get('id', properties.get('name', k+1)))
+            targets.append(geometry_target(tid, sr.shape.__geo_interface__))
+    else:
+        with open(filename, 'r') as fp:
+            geojson = json.load(fp)
+        features = geojson['features'] if geojson.get('type') == 'FeatureCollection' else [geojson]
+        for k, feature in enumerate(features):
+            properties = feature.get('properties') or {}
+            tid = str(properties.get('id', properties.get('name', k+1)))
+            targets.append(geometry_target(tid, feature['geometry']))
+    return targets
+
+def read_targets(filename):
+    # Points [lat,lon], boxes [S,N,W,E] and polygons to extract in one run, from a CSV
+    # file (header with id,lat,lon and/or id,S,N,W,E), a GeoJSON file or a shapefile
+    targets = []
+    if filename.lower().endswith(('.geojson', '.json', '.shp')):
+        targets = read_features(filename)
+    else:
+        with open(filename, 'r', newline='') as fp:
+            sample = fp.read(4096)
+            fp.seek(0)
+            delimiter = ';' if sample.count(';') > sample.count(',') else ','
+            for k, row in enumerate(csv.DictReader(fp, delimiter=delimiter)):
+                row = {key.strip(): (val or '').strip() for key, val in row.items() if key is not None}
+                tid = row.get('id') or str(k+1)
+                try:
+                    if row.get('lat') and row.get('lon'):
+                        targets.append(check_target(tid, 'point', [float(row['lat']), float(row['lon'])]))
+                    elif all(row.get(c) for c in 'SNWE'):
+                        targets.append(check_target(tid, 'box', [float(row[c]) for c in 'SNWE']))
+                    else:
+                        raise ValueError("target %s: a point needs lat,lon and a box needs S,N,W,E" % (tid))
+                except (TypeError, ValueError) as e:
+                    raise ValueError("line %d: %s" % (k+2, e))
+    if not targets:
+        raise ValueError("no target found")
+    ids = [t[0] for t in targets]
+    if len(set(ids)) != len(ids):
+        raise ValueError("the target ids must be unique")
+    return targets
+
+def box_polygons(box):
+    # Box [S,N,W,E] as a polygon target
+    lonbbox = [box[2],box[3],box[3],box[2],box[2]]
+    latbbox = [box[0],box[0],box[1],box[1],box[0]]
+    return [[[[lonbbox[pti1],latbbox[pti1]] for pti1 in range(len(lonbbox))]]]
+
+def target_columns(targets):
+    # (id, statistic) of the extracted values: one value for a point, three for an area
+    columns = []
+    for tid, kind, coords in targets:
+        if kind == 'point':
+            columns.append((tid, 'value'))
+        else:
+            columns.extend([(tid, 'mean'), (tid, 'median'), (tid, 'std')])
+    return columns
+
+class TargetSet:
+    # Cells of all the targets gathered in one array of flat indices, so that the time
+    # steps of a file are sampled for every point and area by a single fancy indexing
+    def __init__(self, targets, grid):
+        self.targets = targets
+        self.columns = target_columns(targets)
+        points = np.array([t[2] for t in targets if t[1] == 'point']).reshape(-1, 2)
+        iy, ix = grid.query(points[:,0], points[:,1])
+        idx_points = list(np.ravel_multi_index((iy, ix), grid.shape))
+        index = []
+        self.slices = []
+        nindex = 0
+        for tid, kind, coords in targets:
+            if kind == 'point':
+                idx = np.array([idx_points.pop(0)], dtype=np.int64)
+            else:
+                idx = grid.cells(box_polygons(coords) if kind == 'box' else coords)
+                if len(idx) == 0:
+                    print("WARNING: no cell of the grid inside the area of target %s" % (tid))
+            self.slices.append((kind, nindex, nindex+len(idx)))
+            index.append(idx)
+            nindex += len(idx)
+        self.index = np.concatenate(index).astype(np.int64)
+
+        # Smallest window of the grid holding all the cells: only this hyperslab is read
+        if len(self.index) > 0:
+            iy, ix = np.unravel_index(self.index, grid.shape)
+            y0, y1, x0, x1 = iy.min(), iy.max()+1, ix.min(), ix.max()+1
+            self.local = (iy-y0)*(x1-x0) + (ix-x0)
+        else:
+            y0, y1, x0, x1 = 0, 1, 0, 1
+            self.local = self.index
+        self.window = (slice(int(y0), int(y1)), slice(int(x0), int(x1)))
+
+        # Identity of the values of each column for the result cache: the grid, the cells of
+        # the target and the statistic (whatever the id of the target)
+        gridkey = '%s_%s' % grid.key if grid.key is not None else ''
+        self.keys = []
+        for kind, i0, i1 in self.slices:
+            cells = hashlib.sha1(self.index[i0:i1].tobytes()).hexdigest()
+            self.keys.extend(['%s:%s:%s' % (gridkey, cells, stat) for stat in (['value'] if kind == 'point' else ['mean', 'median', 'std'])])
+
+    def subspace(self, f, steps=None):
+        # Lazy subspace of a (time, y, x) field restricted to the window and to the
+        # indices [steps] of the time axis
+        if steps is None:
+            tslice = slice(None)
+        elif len(steps) > 0 and steps[-1] - steps[0] == len(steps) - 1:
+            tslice = slice(int(steps[0]), int(steps[-1])+1)
+        else:
+            tslice = np.asarray(steps)
+        return f[tslice, self.window[0], self.window[1]]
+
+    def extract(self, data):
+        # Values of the (time, y, x) data of the window: array (time, len(self.columns)).
+        # Masked (fill) values are NaN and are ignored by the statistics of the areas.
+        data = np.ma.asarray(data)
+        data = np.ma.filled(data.astype(float), np.nan).reshape(data.shape[0], -1)
+        values = data[:, self.local]
+        out = np.empty((data.shape[0], len(self.columns)))
+        col = 0
+        with warnings.catch_warnings():
+            # Areas without valid cells give NaN
+            warnings.simplefilter('ignore', category=RuntimeWarning)
+            for kind, i0, i1 in self.slices:
+                if kind == 'point':
+                    out[:,col] = values[:,i0]
+                    col += 1
+                else:
+                    cells = values[:,i0:i1]
+                    out[:,col] = np.nanmean(cells, axis=1)
+                    out[:,col+1] = np.nanmedian(cells, axis=1)
+                    out[:,col+2] = np.nanstd(cells, axis=1)
+                    col += 3
+        return out
+
+def extract_file(filename, target_set, date1, date2, cache=None):
+    # Dates and values (time, columns) of the targets for the time steps of a file in
+    # [date1, date2]. Run in the workers of the process pool. Only these time steps are
+    # read, and stored in the result cache if any, which serves the next queries within
+    # the dates already read without reading the file. The third element gives the
+    # time spent to read (cf.read and decoding of the window) and to reduce the data.
+    timings = {'read': 0., 'reduce': 0., 'bytes': 0, 'cached': False}
+    result = None
+    if cache is not None:
+        name, size = os.path.basename(filename), os.path.getsize(filename)
+        result = cache.get(name, size, target_set, date1, date2)
+        timings['cached'] = result is not None
+    if result is None:
+        import cf
+        t0 = perf_counter()
+        f = cf.read(filename)[0]
+        datedata = field_dates(f)
+        steps = np.where((datedata >= np.datetime64(date1)) & (datedata <= np.datetime64(date2)))[0]
+        if len(steps) == 0:
+            timings['read'] = perf_counter() - t0
+            return datedata[steps], np.empty((0, len(target_set.columns))), timings
+        data = target_set.subspace(f, steps).data.array
+        t1 = perf_counter()
+        values = target_set.extract(data)
+        timings.update(read=t1-t0, reduce=perf_counter()-t1, bytes=int(data.nbytes))
+        result = (datedata[steps], values)
+        if cache is not None:
+            # Dates covered by the steps read: the file has no other step up to the steps
+            # before and after them
+            seconds = datedata.astype('datetime64[s]').astype(np.int64)
+            first = int(seconds[steps[0]-1]) + 1 if steps[0] > 0 else int(np.iinfo(np.int64).min)
+            end = int(seconds[steps[-1]+1]) if steps[-1] < len(seconds)-1 else int(np.iinfo(np.int64).max)
+            cache.put(name, size, target_set, first, end, *result)
+    datedata, values = result
+    keep = (datedata >= np.datetime64(date1)) & (datedata <= np.datetime64(date2))
+    return datedata[keep], values[keep], timings
+
+def extract_files(list_of_filenames, target_set, date1, date2, nworkers=1, cache=None, metrics=None):
+    # Extraction of many files, fanned out to a process pool, merged in date order
+    results = []
+    if nworkers <= 1 or len(list_of_filenames) <= 1:
+        for filename in tqdm(list_of_filenames):
+            results.append(extract_file(filename, target_set, date1, date2, cache))
+    else:
+        with ProcessPoolExecutor(max_workers=min(nworkers, len(list_of_filenames))) as pool:
+            futures = [pool.submit(extract_file, filename, target_set, date1, date2, cache) for filename in list_of_filenames]
+            for future in tqdm(as_completed(futures), total=len(futures)):
+                results.append(future.result())
+    if metrics is not None:
+        for result in results:
+            metrics.record_extraction(result[2])
+    return merge_results(results, len(target_set.columns))
+
+def write_geotiff(filename, fileout, target_set, date1, date2):
+    # Time steps of a file in [date1, date2] cropped to the window of the ROI and written
+    # band by band (one band per time step) in a tiled and compressed GeoTIFF on the
+    # British National Grid of HadUK-Grid. The cells of the window outside the ROI are
+    # nodata. Run in the workers of the process pool.
+    import cf
+    import rasterio
+    from rasterio.transform import from_origin
+    f = cf.read(filename)[0]
+    datedata = field_dates(f)
+    keep = np.where((datedata >= np.datetime64(date1)) & (datedata <= np.datetime64(date2)))[0]
+    if len(keep) == 0:
+        return None
+
+    # Georeferencing from the projection coordinates (cell centres)
+    xfull = np.asarray(f.constructs('projection_x_coordinate').value().array, dtype=float)
+    yfull = np.asarray(f.constructs('projection_y_coordinate').value().array, dtype=float)
+    x = xfull[target_set.window[1]]
+    y = yfull[target_set.window[0]]
+    dx = abs(xfull[1]-xfull[0])
+    dy = abs(yfull[1]-yfull[0])
+    flip = yfull[1] > yfull[0]
+    inside = np.zeros(len(y)*len(x), dtype=bool)
+    inside[target_set.local] = True
+    inside = inside.reshape(len(y), len(x))
+
+    profile = {'driver': 'GTiff', 'width': len(x), 'height': len(y), 'count': len(keep), 'dtype': 'float32', 
+        'crs': 'EPSG:27700', 'transform': from_origin(x.min()-dx/2, y.max()+dy/2, dx, dy), 'nodata': np.nan, 
+        'compress': 'deflate', 'predictor': 3}
+    if len(x) >= 256 and len(y) >= 256:
+        profile.update({'tiled': True, 'blockxsize': 256, 'blockysize': 256})
+    datestr = np.datetime_as_string(datedata[keep], unit='s')
+    with rasterio.open(fileout + '.part', 'w', **profile) as dst:
+        for band, k in enumerate(keep):
+            # Only one time step of the window is held in memory
+            data = np.ma.filled(np.ma.asarray(target_set.subspace(f, [k]).data.array, dtype=float), np.nan).reshape(len(y), len(x))
+            data[~inside] = np.nan
+            if flip:
+                data = data[::-1]
+            dst.write(data.astype(np.float32), band+1)
+            dst.set_band_description(band+1, datestr[band])
+        dst.update_tags(source=os.path.basename(filename))
+    os.replace(fileout + '.part', fileout)
+    return fileout
+
+def write_geotiffs(list_of_filenames, list_of_fileouts, target_set, date1, date2, nworkers=1):
+    # GeoTIFFs of many files, fanned out to a process pool
+    outputs = []
+    if nworkers <= 1 or len(list_of_filenames) <= 1:
+        for filename, fileout in tqdm(list(zip(list_of_filenames, list_of_fileouts))):
+            outputs.append(write_geotiff(filename, fileout, target_set, date1, date2))
+    else:
+        with ProcessPoolExecutor(max_workers=min(nworkers, len(list_of_filenames))) as pool:
+            futures = [pool.submit(write_geotiff, filename, fileout, target_set, date1, date2) for filename, fileout in zip(list_of_filenames, list_of_fileouts)]
+            for future in tqdm(as_completed(futures), total=len(futures)):
+                outputs.append(future.result())
+    return sorted([fileout for fileout in outputs if fileout is not None])
+
+def merge_results(results, ncolumns):
+    # Concatenation of the (dates, values) of the files in date order
+    if not results:
+        return np.array([], dtype='datetime64[s]'), np.empty((0, ncolumns))
+    dates = np.concatenate([r[0] for r in results])
+    values = np.concatenate([r[1] for r in results], axis=0)
+    order = np.argsort(dates, kind='stable')
+    return dates[order], values[order]
+
+class StreamingExtractor:
+    # Download/extraction pipeline: each file is handed to the process pool as soon as
+    # its transfer is complete (FTPDownloader.on_complete) and, once processed, it is
+    # deleted if asked and its slot of the in-flight window is given back to the
+    # downloader, so that at most [window] files are on disk at the same time.
+    def __init__(self, make_target_set, date1, date2, nworkers=1, window=4, clean=False, cache=None, metrics=None):
+        self.make_target_set = make_target_set
+        self.date1 = date1
+        self.date2 = date2
+        self.cache = cache
+        self.metrics = metrics
+        self.clean = clean
+        self.slots = threading.BoundedSemaphore(max(1, window))
+        self.lock = threading.Lock()
+        self.target_set = None
+        self.futures = []
+        self.errors = []
+        self.pool = ProcessPoolExecutor(max_workers=max(1, nworkers))
+        # Start the workers now, before the download threads are started
+        for future in [self.pool.submit(os.getpid) for k in range(max(1, nworkers))]:
+            future.result()
+
+    def submit(self, filename):
+        try:
+            with self.lock:
+                if self.target_set is None:
+                    self.target_set = self.make_target_set(filename)
+                future = self.pool.submit(extract_file, filename, self.target_set, self.date1, self.date2, self.cache)
+                self.futures.append((filename, future))
+        except Exception as e:
+            self.errors.append('%s (%s)' % (os.path.basename(filename), e))
+            self.slots.release()
+            return
+        future.add_done_callback(lambda fut: self.done(filename))
+
+    def done(self, filename):
+        if self.clean and os.path.exists(filename):
+            os.remove(filename)
+        self.slots.release()
+
+    def results(self):
+        results = []
+        for filename, future in self.futures:
+            try:
+                results.append(future.result())
+                if self.metrics is not None:
+                    self.metrics.record_extraction(results[-1][2])
+            except Exception as e:
+                self.errors.append('%s (%s)' % (os.path.basename(filename), e))
+        self.pool.shutdown()
+        ncolumns = len(self.target_set.columns) if self.target_set is not None else 0
+        return merge_results(results, ncolumns)
+
+    def close(self):
+        # Stop the workers, the files not processed yet are cancelled (failed run)
+        self.pool.shutdown(wait=True, cancel_futures=True)
+
+def write_rows(fout, dates, values, columns, table='wide'):
+    # Rows of the semicolon table: one line per date (wide) or per date and column (long),
+    # gathered in one array and formatted by numpy
+    datestr = np.datetime_as_string(dates, unit='s')
+    if table == 'long':
+        rows = np.empty((len(dates)*len(columns), 4), dtype=object)
+        rows[:,0] = np.repeat(datestr, len(columns))
+        rows[:,1] = np.tile([tid for tid, stat in columns], len(dates))
+        rows[:,2] = np.tile([stat for tid, stat in columns], len(dates))
+        rows[:,3] = np.ravel(values)
+        fmt = '%s;%s;%s;%f'
+    else:
+        rows = np.empty((len(dates), 1+len(columns)), dtype=object)
+        rows[:,0] = datestr
+        rows[:,1:] = values
+        fmt = ';'.join(['%s'] + ['%f']*len(columns))
+    if len(rows) > 0:
+        np.savetxt(fout, rows, fmt=fmt)
+
+class GridIndex:
+    # Geometry of a HadUK-Grid grid: 2-D longitude/latitude of the cells and a KD-tree
+    # on them to find the nearest cell of many points at once. The grid only depends on
+    # (version, resolution), so it is pickled in the cache directory and reused, and kept
+    # in memory for the next jobs of the same process.
+    loaded = {}
+
+    def __init__(self, lon, lat, tree=None):
+        self.lon = np.ma.filled(np.ma.asarray(lon, dtype=float), np.nan)
+        self.lat = np.ma.filled(np.ma.asarray(lat, dtype=float), np.nan)
+        self.shape = self.lon.shape
+        self.cachedirectory = None
+        self.key = None
+        self.masks = {}
+        if tree is not None:
+            self.tree = tree
+        else:
+            try:
+                from scipy.spatial import cKDTree
+                self.tree = cKDTree(np.column_stack((self.lon.ravel(), self.lat.ravel())))
+            except ImportError:
+                self.tree = None
+
+    @staticmethod
+    def path(cachedirectory, version, resolution):
+        return os.path.join(cachedirectory, 'grid_%s_%s.pkl' % (version, resolution))
+
+    @classmethod
+    def load(cls, cachedirectory, version, resolution, filename):
+        # Read the grid from the cache, or from the NetCDF file [filename] the first time
+        fileindex = cls.path(cachedirectory, version, resolution)
+        if fileindex in cls.loaded:
+            return cls.loaded[fileindex]
+        if os.path.exists(fileindex):
+            try:
+                with open(fileindex, 'rb') as fp:
+                    grid = cls(**pickle.load(fp))
+                grid.cachedirectory = cachedirectory
+                grid.key = (version, resolution)
+                cls.loaded[fileindex] = grid
+                return grid
+            except (OSError, pickle.UnpicklingError, EOFError, TypeError):
+                print("WARNING: %s is not readable and will be rebuilt" % (fileindex))
+        import cf
+        f = cf.read(filename)[0]
+        grid = cls(f.constructs('longitude').value().array, f.constructs('latitude').value().array)
+        grid.cachedirectory = cachedirectory
+        grid.key = (version, resolution)
+        tmpname = '%s.%d.tmp' % (fileindex, os.getpid())
+        with open(tmpname, 'wb') as fp:
+            pickle.dump({'lon': grid.lon, 'lat': grid.lat, 'tree': grid.tree}, fp, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmpname, fileindex)
+        cls.loaded[fileindex] = grid
+        return grid
+
+    def query(self, lat, lon):
+        # (y, x) indices of the nearest cells of the points (same lon/lat distance as before)
+        pts = np.column_stack((np.atleast_1d(lon).astype(float), np.atleast_1d(lat).astype(float)))
+        if self.tree is not None:
+            idx = self.tree.query(pts)[1]
+        else:
+            idx = np.array([np.nanargmin((self.lon.ravel()-pt[0])**2 + (self.lat.ravel()-pt[1])**2) for pt in pts], dtype=np.int64)
+        return np.unravel_index(idx, self.shape)
+
+    def cells(self, polygons):
+        # Flat indices of the cells inside the polygons (holes excluded), cached in memory
+        # and in the cache directory for this grid
+        hashkey = hashlib.sha1(json.dumps(polygons).encode()).hexdigest()
+        if hashkey in self.masks:
+            return self.masks[hashkey]
+        filemask = None
+        if self.cachedirectory is not None:
+            filemask = os.path.join(self.cachedirectory, 'mask_%s_%s_%s.npy' % (self.key[0], self.key[1], hashkey))
+            if os.path.exists(filemask):
+                self.masks[hashkey] = np.load(filemask)
+                return self.masks[hashkey]
+        from matplotlib import path
+        lon = self.lon.ravel()
+        lat = self.lat.ravel()
+        mask = np.zeros(lon.shape, dtype=bool)
+        for poly in polygons:
+            exterior = np.asarray(poly[0])
+            # Only the cells in the bounding box of the polygon are tested
+            cand = np.where((lon >= exterior[:,0].min()) & (lon <= exterior[:,0].max()) & (lat >= exterior[:,1].min()) & (lat <= exterior[:,1].max()))[0]
+            areapts = np.column_stack((lon[cand], lat[cand]))
+            inside = path.Path(exterior).contains_points(areapts)
+            for hole in poly[1:]:
+                inside &= ~path.Path(np.asarray(hole)).contains_points(areapts)
+            mask[cand[inside]] = True
+        idx = np.where(mask)[0].astype(np.int64)
+        self.masks[hashkey] = idx
+        if filemask is not None:
+            tmpname = '%s.%d.tmp.npy' % (filemask[:-4], os.getpid())
+            np.save(tmpname, idx)
+            os.replace(tmpname, filemask)
+        return idx
+
+class DataCube:
+    # Local store of the files of one (variable, resolution, temporal): a NetCDF4 file
+    # holding every ingested time step on the full grid, chunked as long time series
+    # over small tiles so that a point or a box reads a few chunks instead of one grid
+    # per time step. The ingested files are recorded in the store (name, size, update,
+    # first time index and number of steps) so that they do not have to be downloaded
+    # again, and so that a file republished in a new update overwrites its own steps.
+    # Chunks (time, y, x): 10 years of monthly or ~2 months of daily steps over 16 x 16
+    # cells, so that a file only rewrites one or two chunks of each tile when ingested
+    chunks = {'mon': (120, 16, 16), 'day': (64, 16, 16)}
+
+    def __init__(self, cubedirectory, variable, resolution, temporal):
+        self.filename = os.path.join(cubedirectory, 'HadUK_Grid_%s_%s_%s_cube.nc' % (resolution, variable, temporal))
+        self.variable = variable
+        self.temporal = temporal
+
+    def attributes(self):
+        # (version, ingested files) of the store, empty if it does not exist
+        if not os.path.exists(self.filename):
+            return '', {}
+        import netCDF4
+        with netCDF4.Dataset(self.filename) as ds:
+            return ds.getncattr('version'), json.loads(ds.getncattr('ingested'))
+
+    def pending(self, version, update, list_of_files, sizes):
+        # Files which are not in the store yet (or have changed). A store of another
+        # version of the dataset is discarded.
+        current, ingested = self.attributes()
+        if current != version and os.path.exists(self.filename):
+            print("\tThe local store %s is from the version %s and is rebuilt" % (self.filename, current))
+            os.remove(self.filename)
+            ingested = {}
+        return [fi for fi in list_of_files if not fi in ingested or ingested[fi]['update'] != update or 
+            (sizes.get(fi) is not None and ingested[fi]['size'] != sizes[fi])]
+
+    def create(self, f, version):
+        import netCDF4
+        lon = np.ma.filled(np.ma.asarray(f.constructs('longitude').value().array, dtype=float), np.nan)
+        lat = np.ma.filled(np.ma.asarray(f.constructs('latitude').value().array, dtype=float), np.nan)
+        x = np.asarray(f.constructs('projection_x_coordinate').value().array, dtype=float)
+        y = np.asarray(f.constructs('projection_y_coordinate').value().array, dtype=float)
+        tmpname = '%s.%d.tmp' % (self.filename, os.getpid())
+        with netCDF4.Dataset(tmpname, 'w', format='NETCDF4') as ds:
+            ds.createDimension('time', None)
+            ds.createDimension('projection_y_coordinate', len(y))
+            ds.createDimension('projection_x_coordinate', len(x))
+            tchunk, ychunk, xchunk = self.chunks.get(self.temporal, self.chunks['day'])
+            t = ds.createVariable('time', 'i8', ('time',), chunksizes=(tchunk,))
+            t.units = 'seconds since 1970-01-01 00:00:00'
+            t.calendar = 'gregorian'
+            t.standard_name = 'time'
+            for name, values in [('projection_y_coordinate', y), ('projection_x_coordinate', x)]:
+                v = ds.createVariable(name, 'f8', (name,))
+                v.standard_name = name
+                v.units = 'm'
+                v[:] = values
+            for name, values in [('latitude', lat), ('longitude', lon)]:
+                v = ds.createVariable(name, 'f8', ('projection_y_coordinate', 'projection_x_coordinate'), fill_value=np.nan)
+                v.standard_name = name
+                v.units = 'degrees_north' if name == 'latitude' else 'degrees_east'
+                v[:] = values
+            v = ds.createVariable(self.variable, 'f4', ('time', 'projection_y_coordinate', 'projection_x_coordinate'), 
+                fill_value=np.float32(np.nan), chunksizes=(tchunk, min(ychunk, len(y)), min(xchunk, len(x))), zlib=True, complevel=1, shuffle=True)
+            v.coordinates = 'latitude longitude'
+            if f.get_property('units', None) is not None:
+                v.units = str(f.get_property('units'))
+            ds.setncattr('version', version)
+            ds.setncattr('ingested', '{}')
+        os.replace(tmpname, self.filename)
+
+    def ingest(self, filename, version, update):
+        # Write all the time steps of a downloaded file in the store: in place of the steps
+        # of its previous ingestion (file republished with the same number of steps), or
+        # appended for a new file
+        import cf
+        import netCDF4
+        f = cf.read(filename)[0]
+        if not os.path.exists(self.filename):
+            self.create(f, version)
+        dates = field_dates(f)
+        data = np.ma.filled(np.ma.asarray(f.data.array, dtype=np.float32), np.nan)
+        with netCDF4.Dataset(self.filename, 'a') as ds:
+            v = ds[self.variable]
+            ingested = json.loads(ds.getncattr('ingested'))
+            previous = ingested.get(os.path.basename(filename))
+            if previous is not None and previous.get('start') is not None and previous['steps'] == len(dates):
+                n = previous['start']
+            else:
+                n = len(ds.dimensions['time'])
+            v[n:n+len(dates), :, :] = data
+            ds['time'][n:n+len(dates)] = (dates - np.datetime64('1970-01-01T00:00:00', 's')).astype(np.int64)
+            # The file is recorded once its time steps are written
+            ingested[os.path.basename(filename)] = {'size': os.path.getsize(filename), 'update': update, 'steps': len(dates), 'start': n}
+            ds.setncattr('ingested', json.dumps(ingested))
+
+    def extract(self, target_set, date1, date2):
+        # Dates and values (time, columns) of the targets in [date1, date2], read from the
+        # window of the targets only. A date written twice (file ingested again) takes
+        # the values of the last ingestion.
+        import netCDF4
+        with netCDF4.Dataset(self.filename) as ds:
+            t = ds['time']
+            dates = decode_time(t[:], t.units)
+            last = len(dates) - 1 - np.unique(dates[::-1], return_index=True)[1]
+            keep = np.sort(last[(dates[last] >= np.datetime64(date1)) & (dates[last] <= np.datetime64(date2))])
+            if len(keep) == 0:
+                return dates[keep], np.empty((0, len(target_set.columns)))
+            tsel = slice(int(keep[0]), int(keep[-1])+1) if keep[-1]-keep[0]+1 == len(keep) else keep
+            data = ds[self.variable][tsel, target_set.window[0], target_set.window[1]]
+        order = np.argsort(dates[keep], kind='stable')
+        return dates[keep][order], target_set.extract(np.ma.asarray(data))[order]
+
+class ResultCache:
+    # Persistent cache of the extracted values (sqlite database of the cache directory):
+    # the time steps read from a file for each column (cells and statistic) of the targets,
+    # with the range of dates [first, end) they cover, keyed by the name and the size of
+    # the file (on the server, so that the files fully cached are not downloaded) and by
+    # the version and update of the dataset it comes from. A query is served from the
+    # cache only if the range of each column covers its dates in this file. The least
+    # recently used values are evicted beyond [maxsize] bytes. The database is opened in
+    # each process using it.
+    def __init__(self, cachedirectory, maxsize, version, update_version):
+        self.filename = os.path.join(cachedirectory, 'results.sqlite')
+        self.maxsize = maxsize
+        self.version = version
+        self.update_version = update_version
+        self.db = None
+
+    def __getstate__(self):
+        return dict(self.__dict__, db=None)
+
+    def connect(self):
+        if self.db is None:
+            import sqlite3
+            self.db = sqlite3.connect(self.filename, timeout=60)
+            self.db.execute('PRAGMA journal_mode=WAL')
+            self.db.execute('CREATE TABLE IF NOT EXISTS series (name TEXT, size INTEGER, version TEXT, update_version TEXT, key TEXT, '
+                'first INTEGER, end INTEGER, dates BLOB, vals BLOB, used REAL, PRIMARY KEY (name, size, version, update_version, key))')
+            self.db.execute('CREATE INDEX IF NOT EXISTS series_used ON series (used)')
+            self.db.commit()
+        return self.db
+
+    def close(self):
+        # The connection can only be used by the thread which opened it
+        if self.db is not None:
+            self.db.close()
+            self.db = None
+
+    def select(self, name, size, keys):
+        # {key: (first, end, dates, values)} of the columns of a file in the cache
+        db = self.connect()
+        found = {}
+        for k in range(0, len(keys), 500):
+            part = keys[k:k+500]
+            query = 'SELECT key, first, end, dates, vals FROM series WHERE name=? AND size=? AND version=? AND update_version=? AND key IN (%s)' % (','.join('?'*len(part)))
+            for key, first, end, dates, vals in db.execute(query, [name, size, self.version, self.update_version] + part):
+                found[key] = (first, end, np.frombuffer(dates, dtype=np.int64), np.frombuffer(vals, dtype=float))
+        return found
+
+    def get(self, name, size, target_set, date1, date2):
+        # Dates and values (time, columns) of the time steps of a file in [date1, date2], or
+        # None if one of the columns is not in the cache for all these dates
+        first = int(np.datetime64(date1, 's').astype(np.int64))
+        end = int(np.datetime64(date2, 's').astype(np.int64)) + 1
+        keys = sorted(set(target_set.keys))
+        found = self.select(name, size, keys)
+        if len(found) < len(keys) or any(found[key][0] > first or found[key][1] < end for key in keys):
+            return None
+        dates = None
+        columns = []
+        for key in target_set.keys:
+            kfirst, kend, kdates, kvals = found[key]
+            keep = (kdates >= first) & (kdates < end)
+            if dates is None:
+                dates = kdates[keep]
+            elif not np.array_equal(dates, kdates[keep]):
+                return None
+            columns.append(kvals[keep])
+        db = self.connect()
+        db.executemany('UPDATE series SET used=? WHERE name=? AND size=? AND version=? AND update_version=? AND key=?', 
+            [(epoch_now(), name, size, self.version, self.update_version, key) for key in keys])
+        db.commit()
+        return dates.astype('datetime64[s]'), np.array(columns).reshape(len(columns), len(dates)).T
+
+    def put(self, name, size, target_set, first, end, dates, values):
+        # Values (time, columns) of the time steps read from a file, which are all its steps
+        # in [first, end) (seconds since 1970), merged with the steps of the cache when
+        # their ranges overlap or follow each other
+        dates = dates.astype('datetime64[s]').astype(np.int64)
+        found = self.select(name, size, sorted(set(target_set.keys)))
+        now = epoch_now()
+        rows = {}
+        for k, key in enumerate(target_set.keys):
+            kfirst, kend, kdates, kvals = first, end, dates, np.asarray(values[:,k], dtype=float)
+            if key in found and found[key][0] <= end and first <= found[key][1]:
+                old = ~np.isin(found[key][2], kdates)
+                kdates = np.concatenate([found[key][2][old], kdates])
+                kvals = np.concatenate([found[key][3][old], kvals])
+                order = np.argsort(kdates, kind='stable')
+                kfirst, kend, kdates, kvals = min(first, found[key][0]), max(end, found[key][1]), kdates[order], kvals[order]
+            rows[key] = (name, size, self.version, self.update_version, key, kfirst, kend, 
+                np.ascontiguousarray(kdates, dtype=np.int64).tobytes(), np.ascontiguousarray(kvals, dtype=float).tobytes(), now)
+        db = self.connect()
+        db.executemany('INSERT OR REPLACE INTO series VALUES (?,?,?,?,?,?,?,?,?,?)', list(rows.values()))
+        db.commit()
+
+        # Eviction of the least recently used values down to 90% of the maximum size
+        pagesize = db.execute('PRAGMA page_size').fetchone()[0]
+        used = (db.execute('PRAGMA page_count').fetchone()[0] - db.execute('PRAGMA freelist_count').fetchone()[0])*pagesize
+        if used > self.maxsize:
+            excess = used - 0.9*self.maxsize
+            rowids = []
+            for rowid, nbytes in db.execute('SELECT rowid, LENGTH(dates) + LENGTH(vals) + LENGTH(key) + 64 FROM series ORDER BY used'):
+                rowids.append((rowid,))
+                excess -= nbytes
+                if excess <= 0:
+                    break
+            db.executemany('DELETE FROM series WHERE rowid=?', rowids)
+            db.commit()
+
+class CatalogCache:
+    # On-disk index of the CEDA directory listings. Listings younger than the TTL are
+    # served from the index; the FTP session is only opened when a listing is missing
+    # or expired, and it can be handed over to the downloader afterwards. There is one
+    # index per server, as the same cache directory may be used with other servers.
+    def __init__(self, cachedirectory, ttl, host, port, username, password, root):
+        self.filename = os.path.join(cachedirectory, 'catalog_%s_%d.json' % (re.sub(r'[^\w.-]', '_', host), port))
+        self.ttl = ttl
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.root = root
+        self.ftp = None
+        self.home = None
+        self.nrequests = 0
+        # Listings read from the server by this instance (see refresh)
+        self.refreshed = set()
+        self.catalog = read_json(self.filename, {'dirs': {}, 'files': {}})
+
+    def session(self):
+        if self.ftp is None:
+            self.ftp = ftp_connect(self.host, self.port, self.username, self.password)
+            self.home = self.ftp.pwd()
+        return self.ftp
+
+    def cwd(self, relpath):
+        ftp = self.session()
+        ftp.cwd(posixpath.join(self.home, self.root, relpath))
+        self.nrequests += 1
+        return ftp
+
+    def fresh(self, entry, relpath, refresh=False):
+        # With [refresh], the listing is read from the server whatever its age (once per
+        # instance, the jobs of a run share the same listings)
+        if refresh and not relpath in self.refreshed:
+            return False
+        return entry is not None and epoch_now() - entry['time'] < self.ttl
+
+    def listdir(self, *keys, refresh=False):
+        relpath = '/'.join(keys)
+        entry = self.catalog['dirs'].get(relpath)
+        if not self.fresh(entry, relpath, refresh):
+            entries = self.cwd(relpath).nlst()
+            self.nrequests += 1
+            entry = {'time': epoch_now(), 'entries': entries}
+            self.catalog['dirs'][relpath] = entry
+            self.refreshed.add(relpath)
+            write_json(self.filename, self.catalog)
+        return entry['entries']
+
+    def list_files(self, version, resolution, variable, temporal, update, refresh=False):
+        # Names, sizes and modification times of the files of an update directory
+        relpath = '/'.join((version, resolution, variable, temporal, update))
+        entry = self.catalog['files'].get(relpath)
+        if not self.fresh(entry, 'files:' + relpath, refresh):
+            ftp = self.cwd(relpath)
+            files = {}
+            try:
+                for name, facts in ftp.mlsd(facts=['type', 'size', 'modify']):
+                    if facts.get('type', 'file') == 'file':
+                        files[name] = {'size': int(facts['size']) if 'size' in facts else None, 'modify': facts.get('modify')}
+            except error_perm:
+                # MLSD is not supported: only the names are known, the sizes are checked at download
+                files = {name: {'size': None, 'modify': None} for name in ftp.nlst()}
+            self.nrequests += 1
+            entry = {'time': epoch_now(), 'files': files}
+            self.catalog['files'][relpath] = entry
+            self.refreshed.add('files:' + relpath)
+            write_json(self.filename, self.catalog)
+        return entry['files']
+
+    def release(self):
+        # Give the open session (if any) to the caller, back in the login directory
+        ftp = self.ftp
+        if ftp is not None:
+            ftp.cwd(self.home)
+        self.ftp = None
+        return ftp
+
+    def close(self):
+        if self.ftp is not None:
+            try:
+                self.ftp.quit()
+            except ftp_errors:
+                self.ftp.close()
+            self.ftp = None
+
+class FTPDownloader:
+    # Pool of N logged-in FTP sessions fed from a shared queue of file names (or of paths
+    # from the login directory, when the directory is empty).
+    # Transfers go to <file>.part, are resumed with REST after an interruption and
+    # are renamed once their size matches the server; completed files are recorded
+    # in a manifest of the work directory.
+    def __init__(self, host, port, username, password, directory, writedirectory, nworkers=4, retries=3, sizes=None, session=None, on_complete=None, slots=None, metrics=None):
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.directory = directory
+        self.writedirectory = writedirectory
+        self.nworkers = max(1, nworkers)
+        self.retries = retries
+        self.lock = threading.Lock()
+        self.files = queue.Queue()
+        self.nbytes = 0
+        self.downloaded = []
+        self.verified = []
+        self.failed = []
+        self.manifest_file = os.path.join(writedirectory, '.hadukgrid_manifest.json')
+        self.manifest = read_json(self.manifest_file, {})
+        # Sizes known from the catalog avoid a SIZE request per file
+        self.sizes = dict(sizes) if sizes is not None else {}
+        self.sessions = queue.Queue()
+        for ftp in (session if isinstance(session, list) else [session]):
+            if ftp is not None:
+                self.sessions.put(ftp)
+        # Optional hand-over of each completed file, and a semaphore bounding the files
+        # held on disk (acquired before a transfer, released by the consumer)
+        self.on_complete = on_complete
+        self.slots = slots
+        self.metrics = metrics
+
+    def connect(self):
+        try:
+            ftp = self.sessions.get_nowait()
+            if self.directory:
+                ftp.cwd(self.directory)
+            return ftp
+        except queue.Empty:
+            t0 = perf_counter()
+            ftp = ftp_connect(self.host, self.port, self.username, self.password, self.directory)
+            if self.metrics is not None:
+                self.metrics.record('ftp_connect', perf_counter() - t0)
+            return ftp
+
+    def local(self, filei):
+        # Name of the downloaded file, [filei] being a name in the directory or a path
+        # from the login directory (with an empty directory)
+        return posixpath.basename(filei)
+
+    def source(self, filei):
+        # Directory of [filei] on the server: the same names are published in each update
+        # directory, so a local copy is only valid for the directory it comes from
+        return posixpath.join(self.directory, posixpath.dirname(filei)).rstrip('/')
+
+    def record(self, filei, size):
+        with self.lock:
+            self.manifest[self.local(filei)] = {'size': size, 'directory': self.source(filei)}
+            write_json(self.manifest_file, self.manifest)
+
+    def remote_size(self, ftp, filei):
+        ftp.voidcmd('TYPE I')
+        try:
+            return ftp.size(filei)
+        except error_perm:
+            return None
+
+    def is_cached(self, filei):
+        # Verification without any request when the catalog gives the size
+        size = self.sizes.get(filei)
+        entry = self.manifest.get(self.local(filei))
+        fileout = os.path.join(self.writedirectory, self.local(filei))
+        return size is not None and entry is not None and entry['size'] == size and entry.get('directory') == self.source(filei) and \
+            os.path.exists(fileout) and os.path.getsize(fileout) == size
+
+    def fetch(self, ftp, filei, pbar):
+        fileout = os.path.join(self.writedirectory, self.local(filei))
+        filepart = fileout + '.part'
+        size = self.sizes.get(filei)
+        if size is None:
+            size = self.remote_size(ftp, filei)
+        entry = self.manifest.get(self.local(filei))
+
+        # A copy (or partial copy) from another directory, e.g. a previous update of the
+        # dataset, is downloaded again whatever its size
+        if entry is not None and entry.get('directory') != self.source(filei):
+            if os.path.exists(fileout):
+                tqdm.write("\t%s: the file comes from %s and will be downloaded again" % (self.local(filei), entry.get('directory')))
+                os.remove(fileout)
+            if os.path.exists(filepart):
+                os.remove(filepart)
+            entry = None
+
+        # Check the cached copy
+        if os.path.exists(fileout):
+            local = os.path.getsize(fileout)
+            if size is None and entry is not None and entry['size'] == local:
+                return None
+            if local == size and (entry is None or entry['size'] == size):
+                if entry is None:
+                    self.record(filei, size)
+                return None
+            if size is not None and local < size and (entry is None or entry['size'] == size):
+                tqdm.write("\t%s: incomplete file (%d/%d B), the transfer will be resumed" % (self.local(filei), local, size))
+                os.replace(fileout, filepart)
+            else:
+                tqdm.write("\t%s: the file does not match the server and will be downloaded again" % (self.local(filei)))
+                os.remove(fileout)
+                if os.path.exists(filepart):
+                    os.remove(filepart)
+
+        # Resume from the partial file if any
+        offset = os.path.getsize(filepart) if os.path.exists(filepart) else 0
+        if size is not None and offset > size:
+            os.remove(filepart)
+            offset = 0
+        pbar.reset(total=size)
+        pbar.set_description(self.local(filei))
+        pbar.update(offset)
+        t0 = perf_counter()
+        nbytes = [0]
+        def write_block(block):
+            fp.write(block)
+            nbytes[0] += len(block)
+            pbar.update(len(block))
+        if size is None or offset < size:
+            with open(filepart, 'ab') as fp:
+                ftp.retrbinary("RETR %s" % (filei), write_block, rest=offset if offset > 0 else None)
+        local = os.path.getsize(filepart)
+        if size is not None and local != size:
+            raise EOFError("incomplete transfer (%d/%d B)" % (local, size))
+        os.replace(filepart, fileout)
+        self.record(filei, local)
+        return nbytes[0], perf_counter() - t0
+
+    def complete(self, filei):
+        if self.on_complete is not None:
+            self.on_complete(os.path.join(self.writedirectory, self.local(filei)))
+
+    def worker(self, position, fbar):
+        ftp = None
+        pbar = tqdm(total=0, position=position, unit='B', unit_scale=True, unit_divisor=1024, leave=False)
+        while True:
+            if self.slots is not None:
+                self.slots.acquire()
+            try:
+                filei = self.files.get_nowait()
+            except queue.Empty:
+                if self.slots is not None:
+                    self.slots.release()
+                break
+            if self.is_cached(filei):
+                with self.lock:
+                    self.verified.append(filei)
+                    fbar.update(1)
+                tqdm.write("\t%s: the file has been found and verified." % (self.local(filei)))
+                self.complete(filei)
+                continue
+            for attempt in range(self.retries):
+                try:
+                    if ftp is None:
+                        ftp = self.connect()
+                    res = self.fetch(ftp, filei, pbar)
+                    if res is None:
+                        with self.lock:
+                            self.verified.append(filei)
+                        tqdm.write("\t%s: the file has been found and verified." % (self.local(filei)))
+                    else:
+                        nbytes, dt = res
+                        with self.lock:
+                            self.nbytes += nbytes
+                            self.downloaded.append(filei)
+                        if self.metrics is not None:
+                            self.metrics.record('download', dt, nbytes)
+                        tqdm.write("\t%s: completed (%.1f MB in %.1f s, %.2f MB/s)." % (self.local(filei), nbytes/1e6, dt, nbytes/1e6/max(dt,1e-9)))
+                    self.complete(filei)
+                    break
+                except ftp_errors as e:
+                    tqdm.write("\t%s: attempt %d/%d failed (%s)" % (self.local(filei), attempt+1, self.retries, e))
+                    if self.metrics is not None:
+                        self.metrics.count('download_errors')
+                    # The size of the catalog may be outdated: ask the server on the next attempt
+                    self.sizes.pop(filei, None)
+                    if ftp is not None:
+                        try:
+                            ftp.close()
+                        except ftp_errors:
+                            pass
+                    ftp = None
+            else:
+                with self.lock:
+                    self.failed.append(filei)
+                if self.slots is not None:
+                    self.slots.release()
+            with self.lock:
+                fbar.update(1)
+        pbar.close()
+        if ftp is not None:
+            try:
+                ftp.quit()
+            except ftp_errors:
+                ftp.close()
+
+    def run(self, list_of_files):
+        for filei in list_of_files:
+            self.files.put(filei)
+        ntodo = self.files.qsize()
+        nworkers = min(self.nworkers, ntodo)
+        print("\t%d file(s) to check or download with %d FTP session(s)" % (ntodo, nworkers))
+        t0 = perf_counter()
+        fbar = tqdm(total=ntodo, position=0, unit='file', desc='Files')
+        threads = [threading.Thread(target=self.worker, args=(k+1, fbar), daemon=True) for k in range(nworkers)]
+        for th in threads:
+            th.start()
+        for th in threads:
+            th.join()
+        fbar.close()
+        while not self.sessions.empty():
+            ftp = self.sessions.get_nowait()
+            try:
+                ftp.quit()
+            except ftp_errors:
+                ftp.close()
+        dt = perf_counter() - t0
+        print("\t%d file(s) verified, %d file(s) downloaded: %.1f MB in %.1f s (%.2f MB/s)" % (len(self.verified), len(self.downloaded), self.nbytes/1e6, dt, self.nbytes/1e6/max(dt,1e-9)))
+        return self.failed
+
+
 ###########################################################################
 # Definition of options
 ###########################################################################
-if len(sys.argv) < 2:
-    prog = os.path.basename(sys.argv[0])
-    print("example: python3 %s -u username -p password -v rainfall -t mon -i 2020-01-01 -j 2020-12-31 -m txt -r 51.51,-0.11 (-w ./tmp) (-o .) (-c True) (-n '')" %
-          sys.argv[0])
-    sys.exit(-1)
-else:
+def build_parser():
     usage = "usage: %prog [options] "
     parser = OptionParser(usage=usage)
     parser.add_option("-u", "--username", dest="username", action="store", type="string", default='username', 
@@ -87,7 +1238,7 @@ else:
     parser.add_option("-m", "--mode", dest="mode", action="store", type="string", default='none', 
         help="Format of saved data: to .[tif] image or .[txt] file")
     parser.add_option("-r", "--ROI", dest="ROI", action="store", type="string", default='0,0', 
-        help="Region Of Interest: can be a point [lat,lon] or a box [S,N,W,E]. The box is mandatory for .tif mode")
+        help="Region Of Interest: can be a point [lat,lon], a box [S,N,W,E] or a GeoJSON file/shapefile of polygons (lon/lat). The box is mandatory for .tif mode")
     parser.add_option("-w", "--writedirectory", dest="writedirectory", action="store", type="string", default='./tmp', 
         help="Directory of the downloaded files: default is [./tmp] (optional)")
     parser.add_option("-o", "--outputdirectory", dest="outputdirectory", action="store", type="string", default='.', 
@@ -100,369 +1251,483 @@ else:
         help="Spatial resolution of data: default is [1km] [1km, 5km, 12km, 25km, 60km] (optional)")  
     parser.add_option("-f", "--figure", dest="figure", action="store", type="string", default='n', 
         help="Generation of quicklook figure: default is n [y or n] (optional)")  
-
-    (options, args) = parser.parse_args()
+    parser.add_option("-b", "--batch", dest="batch", action="store", type="string", default='', 
+        help="CSV (id,lat,lon and/or id,S,N,W,E), GeoJSON file or shapefile of points, boxes and polygons extracted in one run instead of -r (optional)")  
+    parser.add_option("--table", dest="table", action="store", type="string", default='long', 
+        help="Layout of the batch table: [long] (Date;Id;Statistic;Value) or [wide] (one column per target): default is [long] (optional)")  
+    parser.add_option("--format", dest="format", action="store", type="string", default='csv', 
+        help="Format of the txt outputs: [csv] (semicolon table with a header), [parquet] or [feather] (columnar table with the metadata in the schema, needs pyarrow) or [npz] (NumPy arrays): default is [csv] (optional)")  
+    parser.add_option("-d", "--downloadworkers", dest="downloadworkers", action="store", type="int", default=4, 
+        help="Number of simultaneous FTP sessions used to download the data: default is [4] (optional)")  
+    parser.add_option("-x", "--readworkers", dest="readworkers", action="store", type="int", default=1, 
+        help="Number of processes used to read the downloaded files: default is [1] (optional)")  
+    parser.add_option("--stream", dest="stream", action="store", type="string", default='n', 
+        help="Process each file as soon as it is downloaded (and delete it with -c y) while the next ones are downloading: default is [n] [y or n] (optional)")  
+    parser.add_option("--window", dest="window", action="store", type="int", default=4, 
+        help="Maximum number of downloaded files waiting to be processed with --stream y: default is [4] (optional)")  
+    parser.add_option("--cube", dest="cube", action="store", type="string", default='n', 
+        help="Ingest the downloaded files in a local chunked store of the dataset and read the time series from it, the files already ingested are not downloaded again: default is [n] [y or n] (optional)")  
+    parser.add_option("--cubedirectory", dest="cubedirectory", action="store", type="string", default='./cube', 
+        help="Directory of the local stores used with --cube y: default is [./cube] (optional)")  
+    parser.add_option("--incremental", dest="incremental", action="store", type="string", default='n', 
+        help="Update the txt outputs of a previous run: only the new or republished files are downloaded and processed, and only their rows are rewritten: default is [n] [y or n] (optional)")  
+    parser.add_option("--jobs", dest="jobs", action="store", type="string", default='', 
+        help="YAML or JSON file of jobs (options of each job, defaults) processed together: each file is downloaded once and the jobs share the FTP sessions and grids (optional)")  
+    parser.add_option("--metrics", dest="metrics", action="store", type="string", default='', 
+        help="Report of the run (time, bytes and rate of each stage, peak memory): JSON file, or Prometheus text for a .prom file (optional)")  
+    parser.add_option("--profile", dest="profile", action="store", type="string", default='', 
+        help="cProfile statistics of the run written to this file (optional)")  
+    parser.add_option("--tracemalloc", dest="tracemalloc", action="store", type="int", default=0, 
+        help="Trace the memory allocations and add the N largest allocation sites to the --metrics report: default is [0] (optional)")  
+    parser.add_option("--cachedirectory", dest="cachedirectory", action="store", type="string", default=os.path.join(os.path.expanduser('~'), '.cache', 'HadUK-Grid_API'), 
+        help="Directory of the cached catalog of the server: default is [~/.cache/HadUK-Grid_API] (optional)")  
+    parser.add_option("--resultcache", dest="resultcache", action="store", type="float", default=256, 
+        help="Maximum size in MB of the cache of the extracted values (cache directory), 0 to disable it: default is [256] (optional)")  
+    parser.add_option("--cachettl", dest="cachettl", action="store", type="float", default=24, 
+        help="Lifetime of the cached catalog in hours, 0 to refresh it: default is [24] (optional)")  
+    parser.add_option("--server", dest="server", action="store", type="string", default='%s:%d' % (ftp_host, ftp_port), 
+        help="FTP server as [host] or [host:port]: default is [ftp.ceda.ac.uk:21] (optional)")  
+    return parser
 
 ###########################################################################
 # Checking of options
 ###########################################################################
-error=0
-if options.username == 'username': 
-    print("ERROR: please use a valid username for -u option")
-    error=1
-
-if options.password == 'password': 
-    print("ERROR: please use a valid password for -p option")
-    error=1
-
-if not options.variable in ['tasmax', 'tasmin', 'tas', 'rainfall', 'sun', 'sfcWind', 'psl', 'hurs', 'pv', 'groundforst', 'snowLying']:
-    print("ERROR: please use a valid variable name for -v option [tasmax, tasmin, tas, rainfall, sun, sfcWind, psl, hurs, pv, groundforst, snowLying]")
-    error=1
-
-if not options.temporal in ['mon', 'day']:
-    print("ERROR: please use a valid temporal resolution name for -t option [mon, day]")
-    error=1
-
-# # Check the consistency 
-# if options.variable in ['tas','sun', 'sfcWind', 'psl', 'hurs', 'pv', 'groundforst', 'snowLying'] and options.temporal == 'day':
-#     print("ERROR: [%s] option is not possible with the [%s] temporal resolution option" % (options.variable, options.temporal) )
-#     sys.exit(-1)
-
-# Check the dates
-try:
-    date1 = datetime.strptime(options.date1, '%Y-%m-%d')
-except: 
-    print("ERROR: please use a correct date [YYYY-MM-DD] for -i option")
-    sys.exit(-1)
-try:
-    date2 = datetime.strptime(options.date2, '%Y-%m-%d')
-except: 
-    print("ERROR: please use a correct date [YYYY-MM-DD] for -j option")
-    sys.exit(-1)
-
-if date1 > date2: 
-    print("ERROR: The first date must be older than the second date")
-    sys.exit(-1)
-
-if not options.mode in ['tif', 'txt']:
-    print("ERROR: please use a valid mode name for -m option [tif or txt]")
-    error=1
-
-if options.ROI == '0,0':
-    print("ERROR: please use a valid Region Of Interest: can be a point [lat,lon] or a box [S,N,W,E]. The box is mandatory for .tif mode")
-    error=1
-else: 
-    ROI = options.ROI.split(',')
+def parse_roi(roi):
+    # -r option to (ROI, kind): a point [lat,lon], a box [S,N,W,E] or the union of the
+    # polygons of a file
+    if os.path.isfile(roi):
+        try:
+            features = read_features(roi)
+        except (OSError, KeyError, IndexError, TypeError, ValueError) as e:
+            raise HadUKGridError("please use a valid GeoJSON file or shapefile for -r option (%s)" % (e))
+        if not features or any([kind != 'polygon' for tid, kind, coords in features]):
+            raise HadUKGridError("the file of -r option must only contain polygons")
+        return [poly for tid, kind, coords in features for poly in coords], 'polygon'
+    ROI = roi.split(',')
+    if not all([v.replace('.','',1).replace('-','',1).isnumeric() for v in ROI]):
+        raise HadUKGridError("Please use numeric values of -r option")
     if len(ROI) == 2: 
-        lonpt = ROI[1]
-        latpt = ROI[0]
-        if not lonpt.replace('.','',1).replace('-','',1).isnumeric() or not latpt.replace('.','',1).replace('-','',1).isnumeric():
-            print("ERROR: Please use numeric values of -r option: [lon,lat]")
-            sys.exit(-1)
-        else: 
-            if not (float(lonpt) >= -180 and float(lonpt) <= 180) or not (float(latpt) >= -90 and float(latpt) <= 90):
-                print("ERROR: Please use correct values of -r option: [lon,lat]")
-                sys.exit(-1)
-            else: 
-                ROI = [float(latpt),float(lonpt)]
+        latpt, lonpt = float(ROI[0]), float(ROI[1])
+        if not (lonpt >= -180 and lonpt <= 180) or not (latpt >= -90 and latpt <= 90):
+            raise HadUKGridError("Please use correct values of -r option: [lon,lat]")
+        return [latpt,lonpt], 'point'
     elif len(ROI) == 4:
-        S = ROI[0]
-        N = ROI[1]
-        W = ROI[2]
-        E = ROI[3]
-        if not S.replace('.','',1).replace('-','',1).isnumeric() or not N.replace('.','',1).replace('-','',1).isnumeric() or not W.replace('.','',1).replace('-','',1).isnumeric() or not E.replace('.','',1).replace('-','',1).isnumeric():
-            print("ERROR: Please use numeric values of -r option")
-            sys.exit(-1) 
-        else: 
-            if not (float(W) >= -180 and float(W) <= 180) or not (float(E) >= -180 and float(E) <= 180) or not (float(S) >= -90 and float(S) <= 90) or not (float(N) >= -90 and float(N) <= 90):
-                print("ERROR: Please use correct values of -r option: a box [S,N,W,E]")
-                sys.exit(-1)
-            elif float(W) >= float(E) or float(S) >= float(N): 
-                print("ERROR: Please use correct values of -r option: a box [S,N,W,E] ")
-                sys.exit(-1)
-            else: 
-                ROI = [float(S),float(N),float(W),float(E)]
+        S, N, W, E = [float(v) for v in ROI]
+        if not (W >= -180 and W <= 180) or not (E >= -180 and E <= 180) or not (S >= -90 and S <= 90) or not (N >= -90 and N <= 90):
+            raise HadUKGridError("Please use correct values of -r option: a box [S,N,W,E]")
+        elif W >= E or S >= N: 
+            raise HadUKGridError("Please use correct values of -r option: a box [S,N,W,E] ")
+        return [S,N,W,E], 'box'
+    raise HadUKGridError("please use a valid Region Of Interest: can be a point [lat,lon] or a box [S,N,W,E]. The box is mandatory for .tif mode")
+
+def check_options(options):
+    # Checked copy of the options with the dates, the targets and the FTP server parsed.
+    # All the errors are raised together in one HadUKGridError.
+    job = optparse.Values(dict(vars(options)))
+    job.roi_source = options.ROI
+    errors = []
+    if options.username == 'username': 
+        errors.append("please use a valid username for -u option")
+
+    if options.password == 'password': 
+        errors.append("please use a valid password for -p option")
+
+    if not options.variable in ['tasmax', 'tasmin', 'tas', 'rainfall', 'sun', 'sfcWind', 'psl', 'hurs', 'pv', 'groundforst', 'snowLying']:
+        errors.append("please use a valid variable name for -v option [tasmax, tasmin, tas, rainfall, sun, sfcWind, psl, hurs, pv, groundforst, snowLying]")
+
+    if not options.temporal in ['mon', 'day']:
+        errors.append("please use a valid temporal resolution name for -t option [mon, day]")
+
+    # Check the dates
+    try:
+        job.date1 = datetime.strptime(options.date1, '%Y-%m-%d')
+    except ValueError: 
+        raise HadUKGridError("please use a correct date [YYYY-MM-DD] for -i option")
+    try:
+        job.date2 = datetime.strptime(options.date2, '%Y-%m-%d')
+    except ValueError: 
+        raise HadUKGridError("please use a correct date [YYYY-MM-DD] for -j option")
+    if job.date1 > job.date2: 
+        raise HadUKGridError("The first date must be older than the second date")
+
+    if not options.mode in ['tif', 'txt']:
+        errors.append("please use a valid mode name for -m option [tif or txt]")
+
+    # Check the targets
+    if options.batch != '':
+        job.ROI = []
+        job.roi_kind = 'batch'
+        try:
+            job.targets = read_targets(options.batch)
+        except (OSError, KeyError, IndexError, TypeError, ValueError) as e:
+            raise HadUKGridError("please use a valid file of targets for -b option (%s)" % (e))
+        if options.mode == 'tif' or options.figure == 'y':
+            errors.append("the -b option is only compatible with -m txt and -f n")
+        if not options.table in ['long', 'wide']:
+            errors.append("please use a correct table option (--table) [long or wide]")
+    elif options.ROI == '0,0':
+        errors.append("please use a valid Region Of Interest: can be a point [lat,lon] or a box [S,N,W,E]. The box is mandatory for .tif mode")
+        job.ROI, job.roi_kind, job.targets = [], 'none', []
     else:
-        print("ERROR: please use a valid Region Of Interest: can be a point [lat,lon] or a box [S,N,W,E]. The box is mandatory for .tif mode")
-        sys.exit(-1)
-
-if len(ROI) == 2 and options.mode == 'tif':
-    print("ERROR: the point selection for -r option is not compatible with -m tif")
-    sys.exit(-1)      
-
-if not options.clean in ['y','n']:
-    print("ERROR: please use a correct clean option (-c) [y or n]")
-    sys.exit(-1)
-
-if not options.spatial in ['1km', '5km', '12km', '25km', '60km']:
-    print("ERROR: please use a correct spatial resolution option (-s) [[1km, 5km, 12km, 25km, 60km]]")
-    error = 1
-
-if not options.figure in ['y', 'n']:
-    print("ERROR: please use a correct figure option (-f) [y or n]")
-    error = 1
-else:
-    if options.figure == 'y' and options.mode == 'tif':
-        print("ERROR: the -f option (y) is not compatible with -m option (tif)")
-        error = 1
-
-if error == 1:
-    sys.exit(-1)
-
-###########################################################################
-# Creation of work directory
-###########################################################################
-if not options.writedirectory == "." or not options.writedirectory == "" or not options.writedirectory == "/":
-    if not os.path.isdir(options.writedirectory):
-        os.mkdir(options.writedirectory)
-else:
-    print("ERROR: please select a good work directory")
-    sys.exit(-1)
-
-if not options.outputdirectory == "." or not options.outputdirectory == "":
-    if not os.path.isdir(options.outputdirectory):
-        os.mkdir(options.outputdirectory)
-if options.outputdirectory == "":
-    options.outputdirectory == "."
-
-###########################################################################
-# Creation of the list of data
-###########################################################################
-print('First connection to identify the list of data:')
-
-ftp_hadUK_Grid = FTP('ftp.ceda.ac.uk')
-ftp_hadUK_Grid.encoding = "utf-8"
-ftp_hadUK_Grid.login(user=options.username,passwd=options.password)
-ftp_hadUK_Grid.cwd('badc/ukmo-hadobs/data/insitu/MOHC/HadOBS/HadUK-Grid')
-
-# Find the version
-version = ftp_hadUK_Grid.nlst()
-if ver == '':
-    version_grid = version[-1]
-else:
-    if ver in version:
-        version_grid = ver
+        job.ROI, job.roi_kind = parse_roi(options.ROI)
+        job.targets = [('ROI', job.roi_kind, job.ROI)]
+
+    if job.roi_kind == 'point' and options.mode == 'tif':
+        raise HadUKGridError("the point selection for -r option is not compatible with -m tif")
+
+    if not options.format in output_formats:
+        errors.append("please use a correct format option (--format) [csv, parquet, feather or npz]")
+    elif options.format != 'csv' and options.mode != 'txt':
+        errors.append("the --format option (%s) is only compatible with -m txt" % (options.format))
+
+    if not options.clean in ['y','n']:
+        raise HadUKGridError("please use a correct clean option (-c) [y or n]")
+
+    if not options.spatial in ['1km', '5km', '12km', '25km', '60km']:
+        errors.append("please use a correct spatial resolution option (-s) [[1km, 5km, 12km, 25km, 60km]]")
+
+    if not options.figure in ['y', 'n']:
+        errors.append("please use a correct figure option (-f) [y or n]")
+    elif options.figure == 'y' and options.mode == 'tif':
+        errors.append("the -f option (y) is not compatible with -m option (tif)")
+
+    if not options.stream in ['y', 'n']:
+        errors.append("please use a correct stream option (--stream) [y or n]")
+    elif options.stream == 'y' and options.mode != 'txt':
+        errors.append("the --stream option (y) is only compatible with -m txt")
+
+    if not options.cube in ['y', 'n']:
+        errors.append("please use a correct cube option (--cube) [y or n]")
+    elif options.cube == 'y' and options.mode != 'txt':
+        errors.append("the --cube option (y) is only compatible with -m txt")
+    elif options.cube == 'y' and options.stream == 'y':
+        errors.append("the --cube option (y) is not compatible with --stream y")
+
+    if not options.incremental in ['y', 'n']:
+        errors.append("please use a correct incremental option (--incremental) [y or n]")
+    elif options.incremental == 'y' and options.mode != 'txt':
+        errors.append("the --incremental option (y) is only compatible with -m txt")
+    elif options.incremental == 'y' and options.cube == 'y':
+        errors.append("the --incremental option (y) is not compatible with --cube y")
+
+    if options.resultcache < 0:
+        errors.append("please use a positive size for --resultcache option")
+
+    if options.tracemalloc < 0:
+        errors.append("please use a positive number of allocation sites for --tracemalloc option")
+
+    if options.window < 1:
+        errors.append("please use a positive number of files for --window option")
+
+    if options.readworkers < 1:
+        errors.append("please use a positive number of processes for -x option")
+
+    if options.downloadworkers < 1:
+        errors.append("please use a positive number of FTP sessions for -d option")
+
+    server = options.server.split(':')
+    if len(server) == 1 and server[0] != '':
+        job.ftp_host, job.ftp_port = server[0], ftp_port
+    elif len(server) == 2 and server[0] != '' and server[1].isnumeric():
+        job.ftp_host, job.ftp_port = server[0], int(server[1])
     else:
-        ftp_hadUK_Grid.quit()
-        print("ERROR: The desired version of HadUK-Grid does not exist")
-        sys.exit(-1)
-print("\tThe selected version is %s" % (version_grid))
-
-# Find the spatial resolution
-ftp_hadUK_Grid.cwd(version_grid)
-list_res = ftp_hadUK_Grid.nlst()
-if options.spatial in list_res:
-    spt_res = options.spatial
-else:
-    ftp_hadUK_Grid.quit()
-    print("ERROR: The desired spatial resolution of HadUK-Grid does not exist")
-    sys.exit(-1)
-print("\tThe selected spatial resolution is %s" % (spt_res))
-
-# Find the variable
-ftp_hadUK_Grid.cwd(spt_res)
-list_variable = ftp_hadUK_Grid.nlst()
-if options.variable in list_variable:
-    variable = options.variable
-else:
-    ftp_hadUK_Grid.quit()
-    print("ERROR: The desired variable of HadUK-Grid does not exist for these parameters")
-    sys.exit(-1)
-print("\tThe selected variable is %s" % (variable))
-
-# Find the temporal resolution
-ftp_hadUK_Grid.cwd(variable)
-list_type = ftp_hadUK_Grid.nlst()
-if options.temporal in list_type:
-    temp_res = options.temporal
-else:
-    ftp_hadUK_Grid.quit()
-    print("ERROR: The desired temporal resolution of HadUK-Grid does not exist for these parameters")
-    sys.exit(-1)
-print("\tThe selected temporal resolution is %s" % (temp_res))
-
-# Find the update
-ftp_hadUK_Grid.cwd(temp_res)
-list_update = ftp_hadUK_Grid.nlst()
-update_version = list_update[-1]
-print("\tThe selected update version is %s" % (update_version))
-
-# List the available files
-ftp_hadUK_Grid.cwd(update_version)
-list_file_ftp = ftp_hadUK_Grid.nlst()
-
-# Quit the FTP
-ftp_hadUK_Grid.quit()
-print("\tThe list of available data has been found.")
+        errors.append("please use a valid FTP server for --server option [host or host:port]")
+
+    if errors:
+        raise HadUKGridError('\nERROR: '.join(errors))
+    return job
+
+# Options shared by all the jobs of a file of jobs (one catalog, one pool of FTP sessions
+# and one work directory): they are given on the command line or in the defaults
+shared_options = ['username', 'password', 'server', 'writedirectory', 'cachedirectory', 'cachettl', 'downloadworkers', 'clean']
+
+def read_jobs(filename, options):
+    # Checked jobs (see check_options) of a YAML or JSON file: {defaults: {...}, jobs:
+    # [{...}, ...]} or a list of jobs, with the names of the options (-v: variable, -r: ROI...)
+    # as keys. The options missing in a job are taken from the defaults, then from the
+    # command line. Lists of variables, spatial or temporal resolutions give one job per
+    # combination, a list of coordinates is a ROI.
+    load, load_errors = json.load, (OSError, ValueError)
+    if filename.lower().endswith(('.yaml', '.yml')):
+        try:
+            import yaml
+        except ImportError:
+            raise HadUKGridError("the pyyaml package is needed for a YAML file of jobs")
+        load, load_errors = yaml.safe_load, (OSError, ValueError, yaml.YAMLError)
+    try:
+        with open(filename, 'r') as fp:
+            spec = load(fp)
+    except load_errors as e:
+        raise HadUKGridError("please use a valid file of jobs for --jobs option (%s)" % (e))
+    if isinstance(spec, list):
+        spec = {'jobs': spec}
+    if not isinstance(spec, dict) or not isinstance(spec.get('jobs'), list) or not spec['jobs'] or \
+        not all(isinstance(entry, dict) for entry in [spec.get('defaults') or {}] + spec['jobs']):
+        raise HadUKGridError("please use a valid file of jobs for --jobs option (list of jobs, with optional defaults)")
+
+    parser = build_parser()
+    known = {option.dest: option for option in parser.option_list if option.dest is not None and not option.dest in ['jobs', 'metrics', 'profile', 'tracemalloc']}
+    defaults = spec.get('defaults') or {}
+    jobs = []
+    outputs = {}
+    for k, entry in enumerate(spec['jobs']):
+        for key in list(defaults) + list(entry):
+            if not key in known:
+                raise HadUKGridError("job %d: unknown option %s in %s" % (k+1, key, filename))
+        for key in shared_options:
+            if key in entry:
+                raise HadUKGridError("job %d: the %s option is shared by all the jobs, please give it in the defaults or on the command line" % (k+1, key))
+        values = dict(defaults, **entry)
+        expanded = [{}]
+        for key in ['variable', 'spatial', 'temporal']:
+            if isinstance(values.get(key), list):
+                expanded = [dict(combination, **{key: value}) for combination in expanded for value in values[key]]
+        for combination in expanded:
+            options_job = optparse.Values(dict(vars(options)))
+            for key, value in dict(values, **combination).items():
+                if isinstance(value, bool):
+                    value = 'y' if value else 'n'
+                elif isinstance(value, (list, tuple)):
+                    value = ','.join(str(v) for v in value)
+                try:
+                    setattr(options_job, key, known[key].check_value(known[key].get_opt_string(), str(value)))
+                except optparse.OptionValueError as e:
+                    raise HadUKGridError("job %d: %s" % (k+1, e))
+            try:
+                job = check_options(options_job)
+            except HadUKGridError as e:
+                raise HadUKGridError("job %d (%s %s %s): %s" % (k+1, options_job.variable, options_job.spatial, options_job.temporal, e))
+            if job.stream == 'y':
+                raise HadUKGridError("job %d: the --stream option (y) is not compatible with --jobs" % (k+1))
+            output = (os.path.normpath(job.outputdirectory), job.name, job.spatial, job.variable, job.temporal, job.roi_kind == 'batch')
+            if output in outputs:
+                raise HadUKGridError("job %d writes the same outputs as job %d, please give it another name (-n)" % (k+1, outputs[output]))
+            outputs[output] = k+1
+            jobs.append(job)
+    return jobs
 
 ###########################################################################
-# Generation of the list of data which must be downloaded
+# Stages of the processing
 ###########################################################################
-# Conversion of date to file name
-date1 = datetime.strptime(options.date1, '%Y-%m-%d')
-date2 = datetime.strptime(options.date2, '%Y-%m-%d')
-
-list_year = np.arange(date1.year,date2.year+1,1)
-
-list_name_date = []
-if temp_res == 'mon':
-    for yi in list_year:
-        list_name_date.append('%d01-%d12' % (yi,yi))
-elif temp_res == 'day':
-    if len(list_year) == 1:
-        list_month = np.arange(date1.month,date2.month+1,1)
-        for mi in list_month:
-            num_days = monthrange(list_year[0], mi)[1]
-            list_name_date.append('%d%02d01-%d%02d%d' % (list_year[0],mi,list_year[0],mi,num_days))
-    elif len(list_year) > 1:
-        date_list = date_range_list(date1, date2)
-        for di in date_list:
-            num_days = monthrange(di.year, di.month)[1]
-            list_name_date.append('%d%02d01-%d%02d%d' % (di.year,di.month,di.year,di.month,num_days))
-        list_name_date = np.unique(list_name_date)
-
-# Check the available data
-print('Check the available data:')
-list_of_files = []
-for datai in list_name_date:
-    name1 = "%s_hadukgrid_uk_%s_%s_%s.nc" %(variable,spt_res,temp_res,datai)
-    print('\tFor the file: %s' %(name1))
-    if name1 in list_file_ftp:
-        print('\t\tFOUND')
-        list_of_files.append(name1)
+def check_packages(job):
+    # Optional packages needed by the outputs of a job
+    if job.mode == 'tif':
+        try:
+            import rasterio
+        except ImportError:
+            raise HadUKGridError("the rasterio package is needed for -m tif")
+    if job.format in ['parquet', 'feather']:
+        try:
+            import pyarrow
+        except ImportError:
+            raise HadUKGridError("the pyarrow package is needed for --format %s" % (job.format))
+
+def make_directories(job):
+    # Creation of work, cache and output directories
+    if job.writedirectory in ["", "/"]:
+        raise HadUKGridError("please select a good work directory")
+    for directory in [job.writedirectory, job.cachedirectory, job.outputdirectory] + ([job.cubedirectory] if job.cube == 'y' else []):
+        if directory != "" and not os.path.isdir(directory):
+            os.makedirs(directory)
+    if job.outputdirectory == "":
+        job.outputdirectory = "."
+
+def find_dataset(catalog, spatial, variable, temporal, version='', refresh=False):
+    # Walk of the catalog: (version, resolution, variable, temporal, update, files). With
+    # [refresh], the updates and the files of the last update are listed on the server
+    # whatever the TTL of the catalog, to find the new updates and files.
+    list_version = catalog.listdir()
+    if version == '':
+        version_grid = list_version[-1]
+    elif version in list_version:
+        version_grid = version
     else:
-        print('\t\tNOT AVAILABLE')
-
-if not list_of_files:
-    print('ERROR: no data avaible between %s and %s' %(date1.strftime("%Y-%m-%d"),date2.strftime("%Y-%m-%d")))
-    sys.exis(-1)
-
-###########################################################################
-# Download the data 
-###########################################################################
-print("Download the data:")
-
-ftp_hadUK_Grid = FTP('ftp.ceda.ac.uk')
-ftp_hadUK_Grid.encoding = "utf-8"
-ftp_hadUK_Grid.login(user=options.username,passwd=options.password)
-ftp_hadUK_Grid.cwd('badc/ukmo-hadobs/data/insitu/MOHC/HadOBS/HadUK-Grid/%s/%s/%s/%s/%s' %(version_grid,spt_res,variable,temp_res,update_version))
-
-for filei in tqdm(list_of_files):
-    print("\tDownload the file %s:" %(filei))
-    if not os.path.exists(options.writedirectory+'/'+filei):
-        with open(options.writedirectory+'/'+filei, 'wb') as fp:
-            ftp_hadUK_Grid.retrbinary("RETR %s" % (filei), fp.write)
-            print("\t\tcompleted.")
+        raise HadUKGridError("The desired version of HadUK-Grid does not exist")
+    print("\tThe selected version is %s" % (version_grid))
+
+    # Find the spatial resolution
+    if not spatial in catalog.listdir(version_grid):
+        raise HadUKGridError("The desired spatial resolution of HadUK-Grid does not exist")
+    print("\tThe selected spatial resolution is %s" % (spatial))
+
+    # Find the variable
+    if not variable in catalog.listdir(version_grid, spatial):
+        raise HadUKGridError("The desired variable of HadUK-Grid does not exist for these parameters")
+    print("\tThe selected variable is %s" % (variable))
+
+    # Find the temporal resolution
+    if not temporal in catalog.listdir(version_grid, spatial, variable):
+        raise HadUKGridError("The desired temporal resolution of HadUK-Grid does not exist for these parameters")
+    print("\tThe selected temporal resolution is %s" % (temporal))
+
+    # Find the update
+    update_version = catalog.listdir(version_grid, spatial, variable, temporal, refresh=refresh)[-1]
+    print("\tThe selected update version is %s" % (update_version))
+
+    # List the available files
+    files_ftp = catalog.list_files(version_grid, spatial, variable, temporal, update_version, refresh=refresh)
+    print("\tThe list of available data has been found (%d FTP request(s))." % (catalog.nrequests))
+    return version_grid, spatial, variable, temporal, update_version, files_ftp
+
+def select_files(variable, spt_res, temp_res, date1, date2, list_file_ftp):
+    # Names of the files covering [date1, date2] which are available on the server
+    list_year = np.arange(date1.year,date2.year+1,1)
+
+    list_name_date = []
+    if temp_res == 'mon':
+        for yi in list_year:
+            list_name_date.append('%d01-%d12' % (yi,yi))
+    elif temp_res == 'day':
+        if len(list_year) == 1:
+            list_month = np.arange(date1.month,date2.month+1,1)
+            for mi in list_month:
+                num_days = monthrange(list_year[0], mi)[1]
+                list_name_date.append('%d%02d01-%d%02d%d' % (list_year[0],mi,list_year[0],mi,num_days))
+        elif len(list_year) > 1:
+            date_list = date_range_list(date1, date2)
+            for di in date_list:
+                num_days = monthrange(di.year, di.month)[1]
+                list_name_date.append('%d%02d01-%d%02d%d' % (di.year,di.month,di.year,di.month,num_days))
+            list_name_date = np.unique(list_name_date)
+
+    # Check the available data
+    list_of_files = []
+    for datai in list_name_date:
+        name1 = "%s_hadukgrid_uk_%s_%s_%s.nc" %(variable,spt_res,temp_res,datai)
+        print('\tFor the file: %s' %(name1))
+        if name1 in list_file_ftp:
+            print('\t\tFOUND')
+            list_of_files.append(name1)
+        else:
+            print('\t\tNOT AVAILABLE')
+    return list_of_files
+
+def output_name(outputdirectory, name, spt_res, variable, temp_res, suffix=''):
+    # Path of the outputs without extension
+    if name == "":
+        return "%s/HadUK_Grid_%s_%s_%s%s" %(outputdirectory,spt_res,variable,temp_res,suffix)
+    return "%s/%s_HadUK_Grid_%s_%s_%s%s" %(outputdirectory,name,spt_res,variable,temp_res,suffix)
+
+# Formats of the txt outputs (-m txt) and their extension
+output_formats = {'csv': '.csv', 'parquet': '.parquet', 'feather': '.feather', 'npz': '.npz'}
+
+def column_names(columns, names=None):
+    # Names of the columns of a wide table
+    if names is None:
+        names = [tid if stat == 'value' else '%s_%s' % (tid,stat) for tid, stat in columns]
+    return names
+
+def write_csv(filename, metadata, description, dates, values, columns, table='wide', names=None):
+    # Semicolon table of the results after a header of 9 lines (metadata, description)
+    with open(filename, 'w') as fout:
+        fout.write('HadUK-Grid results\n')
+        for key in ['Version', 'Update', 'Spatial Resolution', 'Temporal Resolution', 'Variable']:
+            fout.write('\t%s:\t%s\n' % (key, metadata[key]))
+        fout.write('\n%s\n' % (description))
+        if table == 'long':
+            fout.write('\nDate;Id;Statistic;Value\n')
+        else:
+            fout.write('\nDate;%s\n' % (';'.join(column_names(columns, names))))
+        write_rows(fout, dates, values, columns, table)
+
+def read_csv(filename, columns, table='wide'):
+    # Dates and values (time, columns) of a txt output written by write_csv
+    with open(filename) as fin:
+        lines = [line.rstrip('\n').split(';') for line in fin.readlines()[10:] if line.strip()]
+    if table == 'long':
+        index = {col: k for k, col in enumerate(columns)}
+        dates = sorted(set(line[0] for line in lines))
+        rows = {di: k for k, di in enumerate(dates)}
+        values = np.full((len(dates), len(columns)), np.nan)
+        for line in lines:
+            values[rows[line[0]], index[(line[1], line[2])]] = float(line[3])
     else:
-        print("\t\tthe file has been found.")
-
-ftp_hadUK_Grid.quit()
-
-###########################################################################
-# Write the txt file if needed
-###########################################################################
-if options.mode == 'txt':
-    if options.name == "":
-        fout = open("%s/HadUK_Grid_%s_%s_%s.csv" %(options.outputdirectory,spt_res,variable,temp_res),'w')
+        dates = [line[0] for line in lines]
+        values = np.array([[float(vi) for vi in line[1:]] for line in lines]).reshape(len(lines), len(columns))
+    return np.array(dates, dtype='datetime64[s]'), values
+
+def write_table(filename, metadata, description, dates, values, columns, table='wide', names=None):
+    # Output of the results in the format of its extension: semicolon table (.csv, see
+    # write_csv), columnar table (.parquet, .feather) with the metadata, the description
+    # and the layout in the schema metadata, or arrays (.npz) with them as JSON
+    if filename.endswith('.csv'):
+        return write_csv(filename, metadata, description, dates, values, columns, table, names)
+    attributes = dict(metadata, Description=description, Table=table)
+    if filename.endswith('.npz'):
+        np.savez_compressed(filename, dates=dates.astype('datetime64[s]'), values=values, 
+            ids=np.array([tid for tid, stat in columns], dtype=str), statistics=np.array([stat for tid, stat in columns], dtype=str), 
+            names=np.array(column_names(columns, names), dtype=str), metadata=np.array(json.dumps(attributes)))
+        return
+    import pyarrow as pa
+    if table == 'long':
+        data = {'Date': np.repeat(dates.astype('datetime64[s]'), len(columns)), 
+            'Id': np.tile([tid for tid, stat in columns], len(dates)), 
+            'Statistic': np.tile([stat for tid, stat in columns], len(dates)), 
+            'Value': np.ravel(values)}
     else:
-        fout = open("%s/%s_HadUK_Grid_%s_%s_%s.csv" %(options.outputdirectory,options.name,spt_res,variable,temp_res),'w')
-
-    fout.write('HadUK-Grid results\n')
-    fout.write('\tVersion:\t%s\n' % (version_grid))
-    fout.write('\tUpdate:\t%s\n' % (update_version))
-    fout.write('\tSpatial Resolution:\t%s\n' % (spt_res))
-    fout.write('\tTemporal Resolution:\t%s\n' % (temp_res))
-    fout.write('\tVariable:\t%s\n' % (variable))
-    if len(ROI) == 2:
-        fout.write('\nFor the point (estimated by nearest distance)\tlat: %f\tlon: %f\n' % (ROI[0],ROI[1]))
-        fout.write('\nDate;Value\n')
-    elif len(ROI) == 4:
-        fout.write('\nFor the ROI [S,N,W,E]: %f,%f,%f,%f\n' % (ROI[0],ROI[1],ROI[2],ROI[3]))
-        fout.write('\nDate;Mean Value;Median Value;STD Value\n')
-
-###########################################################################
-# Read the data (and write the image)
-###########################################################################
-print("Read the data:")
-
-for li in tqdm(list_of_files):
-    print('\tFor %s' %(li))
-    f = cf.read(options.writedirectory+'/'+li)[0]
-    for fi in f:
-
-        # Read the data
-        data = fi.data.array
-        lon = fi.constructs('longitude').value().array
-        lat = fi.constructs('latitude').value().array
-
-        # Read the date
-        time = fi.constructs('time').value().array.flatten()
-        atmos_epoch = datetime(1800, 1, 1, 0, 0, tzinfo=timezone.utc).timestamp()/3600 + time
-        datedatai = datetime.fromtimestamp(atmos_epoch[0]*3600)
-
-        if len(ROI) == 2:
-            # print('\t\tAccording the options, we find the closest pixel to the given point...')
-            disttmp = (lon.flatten()-ROI[1])**2 + (lat.flatten()-ROI[0])**2 
-            idxdisttmp = np.argmin(disttmp)
-            data = data.flatten()
-            datapt = data[idxdisttmp]
-
-            if date1 <= datedatai and date2 >= datedatai:
-                fout.write('%s;%f\n' %(datedatai.strftime("%Y-%m-%dT%H:%M:%S"),datapt))
-
-        elif len(ROI) == 4 and options.mode == 'txt':
-            lonbbox = [ROI[2],ROI[3],ROI[3],ROI[2],ROI[2]]
-            latbbox = [ROI[0],ROI[0],ROI[1],ROI[1],ROI[0]]
-
-            # print('\t\tAccording the options, we compute the variable inside the given ROI...')
-            path_pts = []
-            for pti1 in range(len(lonbbox)):
-                path_pts.append( (lonbbox[pti1],latbbox[pti1]))
-            path_BBOX = path.Path(path_pts)
-            areapts = np.vstack(((lon.flatten()),(lat.flatten()))).T
-            mask_BBOX = path_BBOX.contains_points(areapts)
-            idx = np.where(np.array(mask_BBOX)==True)[0]
-
-            dataptmean = np.mean(data.flatten()[idx])
-            dataptmedian = np.median(data.flatten()[idx])
-            dataptstd = np.std(data.flatten()[idx])
-
-            if date1 <= datedatai and date2 >= datedatai:
-                fout.write('%s;%f;%f;%f\n' %(datedatai.strftime("%Y-%m-%dT%H:%M:%S"),dataptmean,dataptmedian,dataptstd))
-
-fout.close()
-
-###########################################################################
-# Clean the work directory
-###########################################################################
-if options.clean == 'y':
-    print('Clean the downloaded data, but keep the work directory')
-    for li in tqdm(list_of_files):
-        if os.path.exists(options.writedirectory+'/'+li):
-            os.remove(options.writedirectory+'/'+li)
-
-###########################################################################
-# Create the quicklook figure
-###########################################################################
-if options.figure == 'y':
-    print('Create the quicklook figure:')
-    if options.name == "":
-        df = pd.read_csv("%s/HadUK_Grid_%s_%s_%s.csv" %(options.outputdirectory,spt_res,variable,temp_res),skiprows=9,delimiter=';')
+        data = {'Date': dates.astype('datetime64[s]')}
+        for k, name in enumerate(column_names(columns, names)):
+            data[name] = values[:,k]
+    t = pa.table(data).replace_schema_metadata({key: str(value) for key, value in attributes.items()})
+    if filename.endswith('.parquet'):
+        import pyarrow.parquet as pq
+        pq.write_table(t, filename)
     else:
-        df = pd.read_csv("%s/%s_HadUK_Grid_%s_%s_%s.csv" %(options.outputdirectory,options.name,spt_res,variable,temp_res),skiprows=9,delimiter=';')
+        import pyarrow.feather as feather
+        feather.write_feather(t, filename)
+
+def read_table(filename, columns, table='wide'):
+    # Dates and values (time, columns) of an output written by write_table
+    if filename.endswith('.csv'):
+        return read_csv(filename, columns, table)
+    if filename.endswith('.npz'):
+        with np.load(filename) as data:
+            return data['dates'], data['values']
+    if filename.endswith('.parquet'):
+        import pyarrow.parquet as pq
+        t = pq.read_table(filename)
+    else:
+        import pyarrow.feather as feather
+        t = feather.read_table(filename)
+    dates = t.column('Date').to_numpy().astype('datetime64[s]')
+    if table == 'long':
+        index = {col: k for k, col in enumerate(columns)}
+        udates, rows = np.unique(dates, return_inverse=True)
+        cols = [index[col] for col in zip(t.column('Id').to_pylist(), t.column('Statistic').to_pylist())]
+        values = np.full((len(udates), len(columns)), np.nan)
+        values[rows, cols] = t.column('Value').to_numpy()
+        return udates, values
+    values = np.column_stack([t.column(k+1).to_numpy() for k in range(len(columns))]) if columns else np.empty((len(dates), 0))
+    return dates, values.reshape(len(dates), len(columns))
+
+def file_period(name):
+    # [first day, day after the last day) of the time steps of a HadUK-Grid file
+    # (YYYYMM-YYYYMM for the monthly files, YYYYMMDD-YYYYMMDD for the daily files)
+    first, last = name.split('_')[-1][:-3].split('-')
+    if len(last) == 6:
+        end = np.datetime64('%s-%s' % (last[:4], last[4:6]), 'M') + np.timedelta64(1, 'M')
+    else:
+        end = np.datetime64('%s-%s-%s' % (last[:4], last[4:6], last[6:8]), 'D') + np.timedelta64(1, 'D')
+    return np.datetime64('%s-%s-%s' % (first[:4], first[4:6], first[6:8] or '01'), 's'), end.astype('datetime64[s]')
+
+def quicklook(dates, values, filefig, title, variable, roi_kind):
+    # Figure of the time series of a txt output, from its dates and values (time, columns):
+    # the value of a point, or the mean, median and STD of an area
+    import matplotlib.pyplot as plt
+    from matplotlib.dates import YearLocator, MonthLocator, DateFormatter
 
-    datefig = []
-    for di in df['Date']:
-        datefig.append(datetime.strptime(di, "%Y-%m-%dT%H:%M:%S"))
+    datefig = dates.astype('datetime64[s]').astype(object)
 
     if variable == 'rainfall':
-        if len(ROI) == 2:
-            plt.bar(datefig, df['Value'], label="Variable")
-        elif len(ROI) == 4:
-            plt.bar(datefig, df['Mean Value'], label="Mean Variable")
-            plt.errorbar(datefig, df['Mean Value'],df['STD Value'], c="red", label="Mean/STD Values")
+        if roi_kind == 'point':
+            plt.bar(datefig, values[:,0], label="Variable")
+        else:
+            plt.bar(datefig, values[:,0], label="Mean Variable")
+            plt.errorbar(datefig, values[:,0], values[:,2], c="red", label="Mean/STD Values")
+    elif roi_kind == 'point':
+        plt.plot(datefig, values[:,0], c="black", label='Value')
     else:
-        plt.errorbar(datefig, df['Mean Value'],df['STD Value'], c="black", label='Mean and STD values')
+        plt.errorbar(datefig, values[:,0], values[:,2], c="black", label='Mean and STD values')
 
     ax = plt.gca()
     ax.xaxis.set_major_locator(YearLocator())
@@ -472,16 +1737,440 @@ if options.figure == 'y':
     plt.xlabel("Time")
     plt.ylabel("Variable Unit")
     plt.legend(loc='best')
-if options.name == "":
-    plt.title("%s/HadUK_Grid_%s_%s_%s" %(options.outputdirectory,spt_res,variable,temp_res))
-    plt.savefig("%s/HadUK_Grid_%s_%s_%s.pdf" %(options.outputdirectory,spt_res,variable,temp_res), dpi=450)
-else:
-    plt.title("%s/%s_HadUK_Grid_%s_%s_%s" %(options.outputdirectory,options.name,spt_res,variable,temp_res))
-    plt.savefig("%s/%s_HadUK_Grid_%s_%s_%s.pdf" %(options.outputdirectory,options.name,spt_res,variable,temp_res), dpi=450)
-
-    print('Create the quicklook figure: OKAY')
+    plt.title(title)
+    plt.savefig(filefig, dpi=450)
+    plt.close()
+
+def plan_job(job, catalog, metrics):
+    # Files of a job (see check_options) and the part of them which must be downloaded and
+    # read: the files in the local store (--cube), unchanged since the previous outputs
+    # (--incremental) or already extracted (result cache) are skipped
+    plan = optparse.Values()
+
+    ###########################################################################
+    # Creation of the list of data
+    ###########################################################################
+    with metrics.stage('catalog'):
+        nrequests = catalog.nrequests
+        plan.version_grid, plan.spt_res, plan.variable, plan.temp_res, plan.update_version, files_ftp = find_dataset(catalog, job.spatial, job.variable, job.temporal, ver, refresh=job.incremental == 'y')
+
+        ###########################################################################
+        # Generation of the list of data which must be downloaded
+        ###########################################################################
+        print('Check the available data:')
+        list_of_files = select_files(plan.variable, plan.spt_res, plan.temp_res, job.date1, job.date2, list(files_ftp))
+    metrics.count('catalog_requests', catalog.nrequests - nrequests)
+    metrics.count('files_selected', len(list_of_files))
+    if not list_of_files:
+        raise HadUKGridError('no data avaible between %s and %s' %(job.date1.strftime("%Y-%m-%d"),job.date2.strftime("%Y-%m-%d")))
+    plan.list_of_files = list_of_files
+    plan.directory = '%s/%s/%s/%s/%s/%s' %(ftp_root,plan.version_grid,plan.spt_res,plan.variable,plan.temp_res,plan.update_version)
+
+    def make_target_set(filename):
+        # The grid geometry (read from [filename] if not cached) and the cells of the targets
+        grid = GridIndex.load(job.cachedirectory, plan.version_grid, plan.spt_res, filename)
+        return TargetSet(job.targets, grid)
+    plan.make_target_set = make_target_set
+
+    sizes = {fi: files_ftp[fi]['size'] for fi in list_of_files if files_ftp[fi]['size'] is not None}
+    plan.sizes = sizes
+    list_of_downloads = list_of_files
+    plan.cube = None
+    if job.cube == 'y':
+        # Only the files which are not in the local store are downloaded
+        plan.cube = DataCube(job.cubedirectory, plan.variable, plan.spt_res, plan.temp_res)
+        list_of_downloads = plan.cube.pending(plan.version_grid, plan.update_version, list_of_files, sizes)
+        print("\t%d file(s) already in the local store %s" % (len(list_of_files)-len(list_of_downloads), plan.cube.filename))
+
+    if job.mode == 'txt':
+        plan.fileout = output_name(job.outputdirectory, job.name, plan.spt_res, plan.variable, plan.temp_res, '_batch' if job.roi_kind == 'batch' else '')
+        plan.table = job.table if job.roi_kind == 'batch' else 'wide'
+        plan.output = plan.fileout + output_formats[job.format]
+    plan.previous = None
+    if job.incremental == 'y':
+        # Files of the previous outputs (see the provenance file) which are unchanged: same
+        # update (and same size), processed for all their dates in [date1, date2]. A file
+        # republished in a new update is processed again even if its size is the same (its
+        # values may have been corrected). A new version of the dataset or other targets
+        # rebuild the outputs.
+        plan.provenance = {'Version': plan.version_grid, 'Spatial Resolution': plan.spt_res, 'Temporal Resolution': plan.temp_res, 'Variable': plan.variable, 
+            'Targets': hashlib.sha1(json.dumps(job.targets).encode()).hexdigest(), 'Table': plan.table}
+        previous = read_json(plan.fileout + '.json', None)
+        if previous is None or not os.path.exists(plan.output) or any(previous.get(key) != plan.provenance[key] for key in plan.provenance):
+            print("\tNo previous outputs of this dataset and targets: all the files are processed")
+        else:
+            unchanged = {}
+            for fi, rec in previous['Files'].items():
+                first, end = file_period(fi)
+                if fi in list_of_files and rec['update'] == plan.update_version and (sizes.get(fi) is None or rec['size'] == sizes[fi]) and \
+                    np.datetime64(rec['from']) <= max(first, np.datetime64(job.date1, 's')) and np.datetime64(rec['to']) >= min(end - np.timedelta64(1, 's'), np.datetime64(job.date2, 's')):
+                    unchanged[fi] = rec
+            list_of_downloads = [fi for fi in list_of_downloads if not fi in unchanged]
+            print("\t%d file(s) unchanged since the previous outputs, %d file(s) to process" % (len(unchanged), len(list_of_downloads)))
+            plan.previous = previous
+
+    # Values already extracted from the same files (and update) for the same cells: the
+    # files cached for all their dates in [date1, date2] are not downloaded (the grid is
+    # needed to know the cells of the targets)
+    plan.cache = None
+    plan.cached = []
+    if job.resultcache > 0 and job.mode == 'txt' and job.cube == 'n':
+        plan.cache = ResultCache(job.cachedirectory, job.resultcache*1e6, plan.version_grid, plan.update_version)
+        if os.path.exists(GridIndex.path(job.cachedirectory, plan.version_grid, plan.spt_res)):
+            target_set = make_target_set(None)
+            for fi in [fi for fi in list_of_downloads if sizes.get(fi) is not None]:
+                result = plan.cache.get(fi, sizes[fi], target_set, job.date1, job.date2)
+                if result is not None:
+                    keep = (result[0] >= np.datetime64(job.date1)) & (result[0] <= np.datetime64(job.date2))
+                    plan.cached.append((fi, (result[0][keep], result[1][keep])))
+            list_of_downloads = [fi for fi in list_of_downloads if not fi in dict(plan.cached)]
+            print("\t%d file(s) already extracted in the result cache" % (len(plan.cached)))
+            metrics.count('result_cache_hits', len(plan.cached))
+    plan.list_of_downloads = list_of_downloads
+    plan.list_of_processed = list_of_downloads + [fi for fi, result in plan.cached]
+    return plan
+
+def process_job(job, plan, metrics, streamer=None):
+    # Outputs of a planned job (see plan_job) once its files are downloaded, or processed
+    # by the streamer during the download
+    version_grid, spt_res, variable, temp_res, update_version = plan.version_grid, plan.spt_res, plan.variable, plan.temp_res, plan.update_version
+    list_of_files, list_of_downloads, list_of_processed = plan.list_of_files, plan.list_of_downloads, plan.list_of_processed
+    make_target_set = plan.make_target_set
+
+    ###########################################################################
+    # Read the data (and write the outputs)
+    ###########################################################################
+    print("Read the data:")
+    outputs = []
+    if job.mode == 'txt':
+        fileout, output, table, cube = plan.fileout, plan.output, plan.table, plan.cube
+        if streamer is not None:
+            # The files have been processed during the download
+            datedata, values = streamer.results()
+            if streamer.errors:
+                raise HadUKGridError("the extraction failed for %s" % (', '.join(streamer.errors)))
+        elif cube is not None:
+            # Ingestion of the new files, the time series are then read from the store
+            if list_of_downloads:
+                # The files ingested in the meantime (by another job of this dataset) are skipped
+                list_of_downloads = cube.pending(version_grid, update_version, list_of_downloads, plan.sizes)
+            if list_of_downloads:
+                print('\tIngestion of %d file(s) in %s' % (len(list_of_downloads), cube.filename))
+                for li in tqdm(list_of_downloads):
+                    with metrics.stage('ingest'):
+                        cube.ingest(job.writedirectory+'/'+li, version_grid, update_version)
+            target_set = make_target_set(cube.filename)
+            with metrics.stage('cube_extract'):
+                datedata, values = cube.extract(target_set, job.date1, job.date2)
+        elif list_of_downloads:
+            # The grid geometry and the cells of the targets are shared by all the files
+            target_set = make_target_set(job.writedirectory+'/'+list_of_downloads[0])
+
+            # Read the files in parallel, the results are merged in date order
+            print('\tExtraction of %d file(s) with %d process(es)' % (len(list_of_downloads), min(job.readworkers, len(list_of_downloads))))
+            datedata, values = extract_files([job.writedirectory+'/'+li for li in list_of_downloads], target_set, job.date1, job.date2, nworkers=job.readworkers, cache=plan.cache, metrics=metrics)
+        else:
+            datedata, values = np.array([], dtype='datetime64[s]'), None
+        columns = target_columns(job.targets)
+        if len(datedata) == 0:
+            values = np.empty((0, len(columns)))
+        if plan.cached:
+            datedata, values = merge_results([(datedata, values)] + [result for fi, result in plan.cached], len(columns))
+
+        if plan.previous is not None:
+            # Rows of the previous outputs in [date1, date2] which do not come from the
+            # processed files, merged with the new rows
+            olddates, oldvalues = read_table(output, columns, table)
+            keep = (olddates >= np.datetime64(job.date1)) & (olddates <= np.datetime64(job.date2))
+            for li in list_of_processed:
+                first, end = file_period(li)
+                keep &= (olddates < first) | (olddates >= end)
+            print('\t%d row(s) kept from the previous outputs, %d new row(s)' % (np.sum(keep), len(datedata)))
+            datedata, values = merge_results([(olddates[keep], oldvalues[keep]), (datedata, values)], len(columns))
+
+        # Write the txt output
+        metadata = {'Version': version_grid, 'Update': update_version, 'Spatial Resolution': spt_res, 'Temporal Resolution': temp_res, 'Variable': variable}
+        names = None
+        if job.roi_kind == 'batch':
+            description = 'For the %d targets of %s (points estimated by nearest distance)' % (len(job.targets),job.batch)
+        elif job.roi_kind == 'point':
+            description = 'For the point (estimated by nearest distance)\tlat: %f\tlon: %f' % (job.ROI[0],job.ROI[1])
+            names = ['Value']
+        elif job.roi_kind == 'box':
+            description = 'For the ROI [S,N,W,E]: %f,%f,%f,%f' % (job.ROI[0],job.ROI[1],job.ROI[2],job.ROI[3])
+            names = ['Mean Value', 'Median Value', 'STD Value']
+        else:
+            description = 'For the ROI polygon(s) of %s' % (job.roi_source)
+            names = ['Mean Value', 'Median Value', 'STD Value']
+        with metrics.stage('write'):
+            write_table(output, metadata, description, datedata, values, columns, table, names)
+        metrics.count('bytes_written', os.path.getsize(output))
+        metrics.count('rows_written', len(datedata))
+        outputs.append(output)
+        if job.incremental == 'y':
+            # Provenance of the rows: the file (and its update) of each period and the dates
+            # processed in this period
+            date1, date2 = str(np.datetime64(job.date1, 's')), str(np.datetime64(job.date2, 's'))
+            files = {}
+            for fi, rec in (plan.previous['Files'] if plan.previous is not None else {}).items():
+                if fi in list_of_files and not fi in list_of_processed:
+                    files[fi] = dict(rec, **{'from': max(rec['from'], date1), 'to': min(rec['to'], date2)})
+            for li in list_of_processed:
+                files[li] = {'update': update_version, 'size': plan.sizes.get(li), 'from': date1, 'to': date2}
+            plan.provenance['Files'] = files
+            write_json(fileout + '.json', plan.provenance)
+            outputs.append(fileout + '.json')
+
+    elif job.mode == 'tif':
+        # Write the images, one GeoTIFF per file
+        target_set = make_target_set(job.writedirectory+'/'+list_of_files[0])
+        fileout = output_name(job.outputdirectory, job.name, spt_res, variable, temp_res)
+        print('\tCropping of %d file(s) to a window of %d x %d cells' % (len(list_of_files), target_set.window[0].stop-target_set.window[0].start, target_set.window[1].stop-target_set.window[1].start))
+        with metrics.stage('write_geotiff'):
+            outputs.extend(write_geotiffs([job.writedirectory+'/'+li for li in list_of_files], 
+                ['%s_%s.tif' % (fileout, li.split('_')[-1][:-3]) for li in list_of_files], 
+                target_set, job.date1, job.date2, nworkers=job.readworkers))
+        metrics.count('bytes_written', sum(os.path.getsize(fi) for fi in outputs))
+
+    ###########################################################################
+    # Create the quicklook figure (from the values written in the txt output)
+    ###########################################################################
+    if job.figure == 'y':
+        print('Create the quicklook figure:')
+        fileout = output_name(job.outputdirectory, job.name, spt_res, variable, temp_res)
+        with metrics.stage('quicklook'):
+            quicklook(datedata, values, fileout + '.pdf', fileout, variable, job.roi_kind)
+        outputs.append(fileout + '.pdf')
+        print('Create the quicklook figure: OKAY')
+    return outputs
+
+def clean_files(writedirectory, list_of_files):
+    print('Clean the downloaded data, but keep the work directory')
+    for li in tqdm(list_of_files):
+        if os.path.exists(writedirectory+'/'+li):
+            os.remove(writedirectory+'/'+li)
+
+def run(job, metrics=None):
+    # Complete processing of a checked job (see check_options), instrumented by [metrics]
+    if metrics is None:
+        metrics = Metrics()
+    check_packages(job)
+    make_directories(job)
+
+    print('First connection to identify the list of data:')
+    catalog = CatalogCache(job.cachedirectory, job.cachettl*3600, job.ftp_host, job.ftp_port, job.username, job.password, ftp_root)
+    try:
+        plan = plan_job(job, catalog, metrics)
+    except BaseException:
+        catalog.close()
+        raise
+
+    ###########################################################################
+    # Download the data 
+    ###########################################################################
+    print("Download the data:")
+    streamer = None
+    if job.mode == 'txt' and job.stream == 'y':
+        print("\tEach file is processed once downloaded (%d process(es), at most %d file(s) in flight)" % (job.readworkers, job.window))
+        streamer = StreamingExtractor(plan.make_target_set, job.date1, job.date2, nworkers=job.readworkers, window=job.window, clean=job.clean == 'y', cache=plan.cache, metrics=metrics)
+
+    try:
+        downloader = FTPDownloader(job.ftp_host, job.ftp_port, job.username, job.password, 
+            plan.directory, 
+            job.writedirectory, nworkers=job.downloadworkers, 
+            sizes=plan.sizes, 
+            session=catalog.release(), 
+            on_complete=streamer.submit if streamer is not None else None, 
+            slots=streamer.slots if streamer is not None else None, 
+            metrics=metrics)
+        failed = downloader.run(plan.list_of_downloads)
+        metrics.count('files_downloaded', len(downloader.downloaded))
+        metrics.count('files_verified', len(downloader.verified))
+        if failed:
+            raise HadUKGridError("the download failed for %s" % (', '.join(failed)))
+
+        outputs = process_job(job, plan, metrics, streamer)
+    finally:
+        # The workers of the streamer are stopped whatever the outcome of the run
+        if streamer is not None:
+            streamer.close()
+
+    ###########################################################################
+    # Clean the work directory
+    ###########################################################################
+    if job.clean == 'y':
+        clean_files(job.writedirectory, plan.list_of_files)
+    return outputs
+
+def run_jobs(jobs, metrics=None):
+    # Processing of many checked jobs (see read_jobs) sharing one catalog and one pool of
+    # FTP sessions: the files of all the jobs are planned first and each file is
+    # downloaded once. A job is processed as soon as its files are downloaded, while the
+    # next ones are downloading, unless it forks read workers (-x) or draws a figure:
+    # these jobs are processed once the downloads are finished.
+    if metrics is None:
+        metrics = Metrics()
+    for job in jobs:
+        check_packages(job)
+        make_directories(job)
+    shared = jobs[0]
+
+    print('First connection to identify the list of data:')
+    catalog = CatalogCache(shared.cachedirectory, shared.cachettl*3600, shared.ftp_host, shared.ftp_port, shared.username, shared.password, ftp_root)
+    plans = []
+    try:
+        for k, job in enumerate(jobs):
+            print('Job %d/%d: %s %s %s' % (k+1, len(jobs), job.variable, job.spatial, job.temporal))
+            plans.append(plan_job(job, catalog, metrics))
+    except BaseException:
+        catalog.close()
+        raise
+    for plan in plans:
+        if plan.cache is not None:
+            plan.cache.close()
+
+    ###########################################################################
+    # Download the data of all the jobs
+    ###########################################################################
+    print("Download the data:")
+    lock = threading.Lock()
+    ready = queue.Queue()
+    remaining = [set(plan.list_of_downloads) for plan in plans]
+    early = [job.readworkers == 1 and job.figure == 'n' for job in jobs]
+    paths = {}
+    sizes = {}
+    for k, plan in enumerate(plans):
+        for fi in plan.list_of_downloads:
+            paths[fi] = plan.directory + '/' + fi
+            if fi in plan.sizes:
+                sizes[paths[fi]] = plan.sizes[fi]
+        if early[k] and not remaining[k]:
+            ready.put(k)
+    print("\t%d file(s) needed by %d job(s), %d different file(s)" % (sum(len(plan.list_of_downloads) for plan in plans), len(jobs), len(paths)))
+
+    def on_complete(filename):
+        with lock:
+            for k in range(len(jobs)):
+                if os.path.basename(filename) in remaining[k]:
+                    remaining[k].discard(os.path.basename(filename))
+                    if early[k] and not remaining[k]:
+                        ready.put(k)
+
+    outputs = [None]*len(jobs)
+    errors = {}
+    def process(k):
+        print('Job %d/%d: %s %s %s' % (k+1, len(jobs), jobs[k].variable, jobs[k].spatial, jobs[k].temporal))
+        try:
+            outputs[k] = process_job(jobs[k], plans[k], metrics)
+        except Exception as e:
+            errors[k] = str(e)
+
+    def processor():
+        for k in iter(ready.get, None):
+            process(k)
+    thread = threading.Thread(target=processor, daemon=True)
+    thread.start()
+
+    downloader = FTPDownloader(shared.ftp_host, shared.ftp_port, shared.username, shared.password, 
+        '', 
+        shared.writedirectory, nworkers=shared.downloadworkers, 
+        sizes=sizes, 
+        session=catalog.release(), 
+        on_complete=on_complete, 
+        metrics=metrics)
+    try:
+        failed = downloader.run(list(paths.values()))
+    finally:
+        ready.put(None)
+        thread.join()
+    metrics.count('files_downloaded', len(downloader.downloaded))
+    metrics.count('files_verified', len(downloader.verified))
+
+    ###########################################################################
+    # Read the data of the other jobs
+    ###########################################################################
+    for k in range(len(jobs)):
+        if remaining[k]:
+            errors[k] = "the download failed for %s" % (', '.join(sorted(remaining[k])))
+        elif outputs[k] is None and not k in errors:
+            process(k)
+
+    ###########################################################################
+    # Clean the work directory
+    ###########################################################################
+    if shared.clean == 'y':
+        clean_files(shared.writedirectory, sorted(set(fi for plan in plans for fi in plan.list_of_files)))
+    if errors:
+        raise HadUKGridError('\nERROR: '.join("job %d (%s %s %s): %s" % (k+1, jobs[k].variable, jobs[k].spatial, jobs[k].temporal, errors[k]) for k in sorted(errors)))
+    return [fi for output in outputs for fi in output]
 
 ###########################################################################
-## END
+# Main
 ###########################################################################
-print('END OF THE PROCESSING')
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+    print("****************************************************************************************************************************")
+    print("API_HadUKGrid_data.py: Script to download the weather data from HadUK-Grid")
+    print("****************************************************************************************************************************")
+
+    if len(argv) < 1:
+        print("example: python3 %s -u username -p password -v rainfall -t mon -i 2020-01-01 -j 2020-12-31 -m txt -r 51.51,-0.11 (-w ./tmp) (-o .) (-c True) (-n '')" %
+              os.path.basename(sys.argv[0]))
+        return -1
+    (options, args) = build_parser().parse_args(argv)
+
+    try:
+        if options.jobs != '':
+            jobs = read_jobs(options.jobs, options)
+            job = jobs[0]
+        else:
+            jobs = None
+            job = check_options(options)
+    except HadUKGridError as e:
+        print("ERROR: %s" % (e))
+        return -1
+
+    # Instrumentation of the run (optional profiling hooks)
+    metrics = Metrics()
+    profiler = None
+    if job.profile != '':
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+    if job.tracemalloc > 0:
+        import tracemalloc
+        tracemalloc.start()
+    status = 'failed'
+    try:
+        if jobs is not None:
+            run_jobs(jobs, metrics)
+        else:
+            run(job, metrics)
+        status = 'success'
+    except HadUKGridError as e:
+        print("ERROR: %s" % (e))
+        return -1
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(job.profile)
+            print('Profile of the run written in %s' % (job.profile))
+        if job.tracemalloc > 0:
+            metrics.extra['tracemalloc_peak_mb'] = tracemalloc.get_traced_memory()[1]/1e6
+            metrics.extra['tracemalloc_top'] = ['%s: %.1f MB in %d block(s)' % (stat.traceback, stat.size/1e6, stat.count) 
+                for stat in tracemalloc.take_snapshot().statistics('lineno')[:job.tracemalloc]]
+            tracemalloc.stop()
+        if job.metrics != '':
+            metrics.extra['status'] = status
+            metrics.write(job.metrics)
+            print('Report of the run written in %s' % (job.metrics))
+
+    ###########################################################################
+    ## END
+    ###########################################################################
+    print('END OF THE PROCESSING')
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,426 @@
+#! /usr/bin/env python3
+# -*- coding: iso-8859-1 -*-
+
+##########################################################################################
+# Header information
+###########################################################################
+
+"""benchmark_HadUKGrid.py: Offline benchmark of the stages of API_HadUKGrid_data.py"""
+
+__author__ = "Alexis Hrysiewicz"
+__copyright__ = "Copyright 2022"
+__credits__ = ["Alexis Hrysiewicz"]
+__license__ = "GPLV3"
+__version__ = "0.5.0"
+__maintainer__ = "Alexis Hrysiewicz"
+__status__ = "Production"
+__date__ = "Aug. 2022"
+
+###########################################################################
+# Python packages
+###########################################################################
+# Synthetic HadUK-Grid files (netCDF4) are served by a local FTP server (pyftpdlib)
+# started in another process, so that no network access is needed. cf is only needed
+# by the read and extract stages, which are skipped without it.
+import sys
+import os
+import io
+import shutil
+import socket
+import threading
+import multiprocessing
+import contextlib
+from time import perf_counter, sleep
+from datetime import datetime
+from calendar import monthrange
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import API_HadUKGrid_data as haduk
+
+###########################################################################
+# Synthetic dataset
+###########################################################################
+# Grids of HadUK-Grid on the British National Grid: (ny, nx, cell size in m) with the
+# lower left corner at (-200000, -200000)
+grids = {'1km': (1450, 900, 1000.), '5km': (290, 180, 5000.), '12km': (112, 82, 12000.),
+    '25km': (58, 36, 25000.), '60km': (25, 15, 60000.)}
+version = 'v1.1.0.0'
+update = 'v20220310'
+variable = 'rainfall'
+username = 'benchmark'
+password = 'benchmark'
+
+def grid_coordinates(resolution):
+    # Projection coordinates of the cell centres and their longitude/latitude (spherical
+    # approximation of the British National Grid, enough for the benchmark)
+    ny, nx, step = grids[resolution]
+    x = -200000 + step*(np.arange(nx) + 0.5)
+    y = -200000 + step*(np.arange(ny) + 0.5)
+    yy, xx = np.meshgrid(y, x, indexing='ij')
+    lat = 49 + (yy + 100000)/111000.
+    lon = -2 + (xx - 400000)/(111320.*np.cos(np.radians(lat)))
+    return x, y, lon, lat
+
+def file_dates(temporal, year, month=None):
+    # Name period and time steps (mid-month or midday) of the file of a year (mon) or
+    # of a month (day)
+    if temporal == 'mon':
+        return '%d01-%d12' % (year, year), [datetime(year, m, 16, 12) for m in range(1, 13)]
+    ndays = monthrange(year, month)[1]
+    return '%d%02d01-%d%02d%02d' % (year, month, year, month, ndays), [datetime(year, month, d, 12) for d in range(1, ndays+1)]
+
+def write_file(filename, resolution, dates, seed):
+    # CF NetCDF file shaped as the HadUK-Grid files: (time, y, x) float32 with fill values
+    # outside the "land" ellipse, 2-D latitude/longitude and the transverse mercator grid
+    import netCDF4
+    x, y, lon, lat = grid_coordinates(resolution)
+    yy, xx = np.meshgrid(np.linspace(-1, 1, len(y)), np.linspace(-1, 1, len(x)), indexing='ij')
+    sea = (xx/0.9)**2 + (yy/0.95)**2 > 1
+    rng = np.random.default_rng(seed)
+    tmpname = filename + '.tmp'
+    with netCDF4.Dataset(tmpname, 'w', format='NETCDF4') as ds:
+        ds.Conventions = 'CF-1.5'
+        ds.title = 'Synthetic HadUK-Grid file for benchmark_HadUKGrid.py'
+        ds.createDimension('time', None)
+        ds.createDimension('projection_y_coordinate', len(y))
+        ds.createDimension('projection_x_coordinate', len(x))
+        ds.createDimension('bnds', 2)
+        t = ds.createVariable('time', 'f8', ('time',))
+        t.standard_name = 'time'
+        t.units = 'hours since 1800-01-01 00:00:00'
+        t.calendar = 'gregorian'
+        t.bounds = 'time_bnds'
+        t[:] = [(di - datetime(1800, 1, 1)).total_seconds()/3600. for di in dates]
+        tb = ds.createVariable('time_bnds', 'f8', ('time', 'bnds'))
+        tb[:] = np.column_stack((t[:] - 12, t[:] + 12))
+        for name, values in [('projection_y_coordinate', y), ('projection_x_coordinate', x)]:
+            v = ds.createVariable(name, 'f8', (name,))
+            v.standard_name = name
+            v.units = 'm'
+            v[:] = values
+        for name, values in [('latitude', lat), ('longitude', lon)]:
+            v = ds.createVariable(name, 'f8', ('projection_y_coordinate', 'projection_x_coordinate'))
+            v.standard_name = name
+            v.units = 'degrees_north' if name == 'latitude' else 'degrees_east'
+            v[:] = values
+        crs = ds.createVariable('transverse_mercator', 'i4')
+        crs.grid_mapping_name = 'transverse_mercator'
+        crs.longitude_of_central_meridian = -2.
+        crs.latitude_of_projection_origin = 49.
+        crs.false_easting = 400000.
+        crs.false_northing = -100000.
+        crs.scale_factor_at_central_meridian = 0.9996012717
+        v = ds.createVariable(variable, 'f4', ('time', 'projection_y_coordinate', 'projection_x_coordinate'),
+            fill_value=np.float32(1e20), zlib=True, complevel=4, chunksizes=(1, len(y), len(x)))
+        v.standard_name = 'lwe_thickness_of_precipitation_amount'
+        v.units = 'mm'
+        v.coordinates = 'latitude longitude'
+        v.grid_mapping = 'transverse_mercator'
+        for k in range(len(dates)):
+            field = 50 + 30*np.sin(3*xx + k) * np.cos(2*yy) + rng.gamma(2., 5., size=xx.shape)
+            v[k,:,:] = np.where(sea, np.float32(1e20), field.astype(np.float32))
+    os.replace(tmpname, filename)
+
+def make_dataset(rootdirectory, resolution, temporal, years):
+    # Files of the synthetic dataset in the FTP tree, written once and reused
+    directory = os.path.join(rootdirectory, haduk.ftp_root, version, resolution, variable, temporal, update)
+    os.makedirs(directory, exist_ok=True)
+    files = []
+    nsteps = 0
+    for year in years:
+        for month in ([None] if temporal == 'mon' else range(1, 13)):
+            period, dates = file_dates(temporal, year, month)
+            name = '%s_hadukgrid_uk_%s_%s_%s.nc' % (variable, resolution, temporal, period)
+            if not os.path.exists(os.path.join(directory, name)):
+                write_file(os.path.join(directory, name), resolution, dates, seed=len(files))
+            files.append(name)
+            nsteps += len(dates)
+    return directory, files, nsteps
+
+###########################################################################
+# Local FTP server
+###########################################################################
+def serve(rootdirectory, port):
+    from pyftpdlib.authorizers import DummyAuthorizer
+    from pyftpdlib.handlers import FTPHandler
+    from pyftpdlib.servers import ThreadedFTPServer
+    authorizer = DummyAuthorizer()
+    authorizer.add_user(username, password, rootdirectory, perm='elr')
+    handler = FTPHandler
+    handler.authorizer = authorizer
+    handler.banner = 'benchmark_HadUKGrid.py'
+    import logging
+    from pyftpdlib.log import config_logging
+    config_logging(level=logging.WARNING)
+    ThreadedFTPServer(('127.0.0.1', port), handler).serve_forever()
+
+def start_server(rootdirectory):
+    # FTP server in another process (it does not share the CPU time of the benchmark)
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+    process = multiprocessing.Process(target=serve, args=(rootdirectory, port), daemon=True)
+    process.start()
+    for k in range(100):
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return process, port
+        except OSError:
+            sleep(0.05)
+    process.terminate()
+    raise haduk.HadUKGridError("the local FTP server did not start")
+
+###########################################################################
+# Measurements
+###########################################################################
+def rss():
+    # Resident memory of the process in MB (/proc on Linux, high-water mark otherwise)
+    try:
+        with open('/proc/self/statm') as fin:
+            return int(fin.read().split()[1])*os.sysconf('SC_PAGE_SIZE')/1e6
+    except (OSError, ValueError, AttributeError):
+        import resource
+        maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return maxrss/1e6 if sys.platform == 'darwin' else maxrss/1e3
+
+class PeakMemory:
+    # Peak resident memory during a stage, sampled every [interval] seconds
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.start = self.peak = rss()
+        self.stop = threading.Event()
+        self.thread = threading.Thread(target=self.sample, daemon=True)
+
+    def sample(self):
+        while not self.stop.is_set():
+            self.peak = max(self.peak, rss())
+            self.stop.wait(self.interval)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop.set()
+        self.thread.join()
+        self.peak = max(self.peak, rss())
+
+def measure(stage, func, repeat, amount, unit, setup=None):
+    # Best and median wall time of [repeat] runs of func(), rate of [amount] [unit] per
+    # second for the best run and peak resident memory. The outputs of the stage are
+    # hidden.
+    times = []
+    peak = delta = 0
+    for k in range(repeat):
+        if setup is not None:
+            setup()
+        with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()), PeakMemory() as memory:
+            t0 = perf_counter()
+            func()
+            times.append(perf_counter() - t0)
+        peak = max(peak, memory.peak)
+        delta = max(delta, memory.peak - memory.start)
+    best = min(times)
+    result = {'time': best, 'median': float(np.median(times)), 'amount': amount, 'unit': unit,
+        'rate': amount/max(best, 1e-9), 'peak_rss_mb': peak, 'delta_rss_mb': delta}
+    print('\t%-18s %9.4f s (median %9.4f s) %12.2f %s/s   peak RSS %8.1f MB (+%.1f MB)' % (stage, best, result['median'], result['rate'], unit, peak, delta))
+    return result
+
+###########################################################################
+# Stages
+###########################################################################
+def benchmark_case(workdirectory, port, resolution, temporal, years, options, has_cf):
+    # All the stages for one (resolution, temporal) dataset
+    results = {}
+    directory, files, nsteps = make_dataset(os.path.join(workdirectory, 'ftp'), resolution, temporal, years)
+    nbytes = sum(os.path.getsize(os.path.join(directory, fi)) for fi in files)
+    print('%s %s: %d file(s), %.1f MB' % (resolution, temporal, len(files), nbytes/1e6))
+    date1, date2 = datetime(years[0], 1, 1), datetime(years[-1], 12, 31)
+    cachedirectory = os.path.join(workdirectory, 'cache')
+    writedirectory = os.path.join(workdirectory, 'download')
+
+    def reset(directory):
+        shutil.rmtree(directory, ignore_errors=True)
+        os.makedirs(directory)
+
+    # Catalog walk (empty cache) and selection of the files
+    def catalog():
+        cache = haduk.CatalogCache(cachedirectory, 0, '127.0.0.1', port, username, password, haduk.ftp_root)
+        try:
+            found = haduk.find_dataset(cache, resolution, variable, temporal)
+            haduk.select_files(variable, resolution, temporal, date1, date2, list(found[-1]))
+        finally:
+            cache.close()
+    results['catalog'] = measure('catalog', catalog, options.repeat, 1, 'walk', setup=lambda: reset(cachedirectory))
+
+    # Downloads with one session (serial retrbinary) and with the pool of sessions
+    remote = '%s/%s/%s/%s/%s/%s' % (haduk.ftp_root, version, resolution, variable, temporal, update)
+    for stage, nworkers in [('download_serial', 1), ('download_parallel', options.downloadworkers)]:
+        def download():
+            failed = haduk.FTPDownloader('127.0.0.1', port, username, password, remote, writedirectory, nworkers=nworkers).run(files)
+            if failed:
+                raise haduk.HadUKGridError("the download failed for %s" % (', '.join(failed)))
+        results[stage] = measure(stage, download, options.repeat, nbytes/1e6, 'MB', setup=lambda: reset(writedirectory))
+
+    # Grid geometry, nearest cells of the points (KD-tree and one argmin per point) and
+    # cells of a polygon
+    x, y, lon, lat = grid_coordinates(resolution)
+    rng = np.random.default_rng(0)
+    points = np.column_stack((rng.uniform(50.5, 55.5, options.points), rng.uniform(-4.5, 0.5, options.points)))
+    grid = haduk.GridIndex(lon, lat)
+    results['grid_index'] = measure('grid_index', lambda: haduk.GridIndex(lon, lat), options.repeat, lon.size/1e6, 'Mcell')
+    results['nearest_tree'] = measure('nearest_tree', lambda: grid.query(points[:,0], points[:,1]), options.repeat, len(points), 'point')
+    brute = haduk.GridIndex(lon, lat, tree=grid.tree)
+    brute.tree = None
+    results['nearest_argmin'] = measure('nearest_argmin', lambda: brute.query(points[:,0], points[:,1]), options.repeat, len(points), 'point')
+    angle = np.linspace(0, 2*np.pi, 257)
+    polygon = [[list(pt) for pt in np.column_stack((-2 + 1.5*np.cos(angle), 53 + np.sin(angle)))]]
+    def masks():
+        grid.masks = {}
+        grid.cells([polygon])
+    results['masks'] = measure('masks', masks, options.repeat, lon.size/1e6, 'Mcell')
+
+    # Reading of the files and extraction of the points and of a box
+    if has_cf:
+        reset(writedirectory)
+        with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
+            haduk.FTPDownloader('127.0.0.1', port, username, password, remote, writedirectory, nworkers=options.downloadworkers).run(files)
+        filenames = [os.path.join(writedirectory, fi) for fi in files]
+        def read():
+            import cf
+            for filename in filenames:
+                cf.read(filename)[0].data.array
+        results['read'] = measure('read', read, options.repeat, nsteps*lon.size*4/1e6, 'MB')
+        targets = [('p%d' % (k), 'point', [float(pt[0]), float(pt[1])]) for k, pt in enumerate(points)] + [('box', 'box', [52.15, 52.57, -3.94, -2.9])]
+        target_set = haduk.TargetSet(targets, grid)
+        results['extract'] = measure('extract', lambda: haduk.extract_files(filenames, target_set, date1, date2, nworkers=options.readworkers),
+            options.repeat, nsteps, 'step')
+    return results
+
+###########################################################################
+# Comparison with a baseline
+###########################################################################
+def compare(results, baseline, tolerance):
+    # Ratio of the best times to the baseline, and the stages slower by more than
+    # [tolerance] (and by more than 5 ms, below which the timings are mostly noise)
+    regressions = []
+    print('Comparison with the baseline:')
+    for case in sorted(results):
+        for stage in sorted(results[case]):
+            if not stage in baseline.get(case, {}):
+                continue
+            ratio = results[case][stage]['time']/max(baseline[case][stage]['time'], 1e-9)
+            slower = results[case][stage]['time'] - baseline[case][stage]['time'] > 0.005
+            flag = ''
+            if ratio > 1 + tolerance and slower:
+                regressions.append('%s/%s' % (case, stage))
+                flag = '  REGRESSION'
+            elif ratio < 1/(1 + tolerance) and not slower:
+                flag = '  faster'
+            print('\t%-10s %-18s %9.4f s vs %9.4f s (x%.2f)%s' % (case, stage, results[case][stage]['time'], baseline[case][stage]['time'], ratio, flag))
+    return regressions
+
+###########################################################################
+# Definition of options
+###########################################################################
+def build_parser():
+    usage = "usage: %prog [options] "
+    parser = haduk.OptionParser(usage=usage)
+    parser.add_option("-s", "--spatial", dest="spatial", action="store", type="string", default='5km,12km',
+        help="Spatial resolutions of the synthetic datasets: default is [5km,12km] [1km, 5km, 12km, 25km, 60km] (optional)")
+    parser.add_option("-t", "--temporal", dest="temporal", action="store", type="string", default='mon,day',
+        help="Temporal resolutions of the synthetic datasets: default is [mon,day] (optional)")
+    parser.add_option("-y", "--years", dest="years", action="store", type="int", default=1,
+        help="Number of years of data (from 2020): default is [1] (optional)")
+    parser.add_option("-n", "--repeat", dest="repeat", action="store", type="int", default=3,
+        help="Number of runs of each stage (the best time is kept): default is [3] (optional)")
+    parser.add_option("--points", dest="points", action="store", type="int", default=100,
+        help="Number of points of the nearest cell and extraction stages: default is [100] (optional)")
+    parser.add_option("-d", "--downloadworkers", dest="downloadworkers", action="store", type="int", default=4,
+        help="Number of FTP sessions of the parallel download stage: default is [4] (optional)")
+    parser.add_option("-x", "--readworkers", dest="readworkers", action="store", type="int", default=1,
+        help="Number of processes of the extraction stage: default is [1] (optional)")
+    parser.add_option("-w", "--workdirectory", dest="workdirectory", action="store", type="string", default='./benchmark_data',
+        help="Directory of the synthetic files (kept between runs) and of the downloads: default is [./benchmark_data] (optional)")
+    parser.add_option("-o", "--output", dest="output", action="store", type="string", default='',
+        help="JSON file of the results, usable as a baseline (optional)")
+    parser.add_option("-b", "--baseline", dest="baseline", action="store", type="string", default='',
+        help="JSON file of the results of a previous run to compare with (optional)")
+    parser.add_option("--tolerance", dest="tolerance", action="store", type="float", default=0.25,
+        help="Relative slowdown of a stage reported as a regression: default is [0.25] (optional)")
+    return parser
+
+###########################################################################
+# Main
+###########################################################################
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+    print("****************************************************************************************************************************")
+    print("benchmark_HadUKGrid.py: Offline benchmark of the stages of API_HadUKGrid_data.py")
+    print("****************************************************************************************************************************")
+    (options, args) = build_parser().parse_args(argv)
+
+    errors = []
+    resolutions = options.spatial.split(',')
+    temporals = options.temporal.split(',')
+    if any(not res in grids for res in resolutions):
+        errors.append("please use valid spatial resolutions for -s option [1km, 5km, 12km, 25km, 60km]")
+    if any(not temp in ['mon', 'day'] for temp in temporals):
+        errors.append("please use valid temporal resolutions for -t option [mon, day]")
+    if options.years < 1 or options.repeat < 1 or options.points < 1:
+        errors.append("please use positive numbers for -y, -n and --points options")
+    if options.baseline != '' and not os.path.isfile(options.baseline):
+        errors.append("the baseline file %s does not exist" % (options.baseline))
+    try:
+        import pyftpdlib
+        import netCDF4
+    except ImportError:
+        errors.append("the pyftpdlib and netCDF4 packages are needed by the benchmark")
+    if errors:
+        print("ERROR: %s" % ('\nERROR: '.join(errors)))
+        return -1
+    try:
+        import cf
+        has_cf = True
+    except Exception as e:
+        print("WARNING: cf cannot be imported (%s): the read and extract stages are skipped" % (e))
+        has_cf = False
+
+    workdirectory = os.path.abspath(options.workdirectory)
+    years = list(range(2020, 2020 + options.years))
+    print('Generation of the synthetic datasets in %s' % (workdirectory))
+    for res in resolutions:
+        for temp in temporals:
+            make_dataset(os.path.join(workdirectory, 'ftp'), res, temp, years)
+    process, port = start_server(os.path.join(workdirectory, 'ftp'))
+    print('Local FTP server on port %d' % (port))
+
+    results = {}
+    try:
+        for res in resolutions:
+            for temp in temporals:
+                results['%s_%s' % (res, temp)] = benchmark_case(workdirectory, port, res, temp, years, options, has_cf)
+    except haduk.HadUKGridError as e:
+        print("ERROR: %s" % (e))
+        return -1
+    finally:
+        process.terminate()
+        process.join()
+
+    report = {'date': datetime.now().isoformat(timespec='seconds'), 'python': sys.version.split()[0], 'numpy': np.__version__,
+        'cpus': os.cpu_count(), 'years': options.years, 'repeat': options.repeat, 'points': options.points, 'results': results}
+    if options.output != '':
+        haduk.write_json(options.output, report)
+        print('Results written in %s' % (options.output))
+    if options.baseline != '':
+        regressions = compare(results, haduk.read_json(options.baseline, {}).get('results', {}), options.tolerance)
+        if regressions:
+            print("ERROR: %d stage(s) slower than the baseline: %s" % (len(regressions), ', '.join(regressions)))
+            return 1
+    print('END OF THE BENCHMARK')
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,71 @@
+# Transfers of FTPDownloader against a local FTP server (see benchmark_HadUKGrid.py):
+# resume of a partial file, rejection of cached copies which do not match the server
+import os
+import sys
+import json
+import pytest
+
+pytest.importorskip('pyftpdlib')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import API_HadUKGrid_data as haduk
+import benchmark_HadUKGrid as benchmark
+
+directory = 'data/v20220310'
+name = 'rainfall_hadukgrid_uk_5km_mon_202001-202012.nc'
+content = os.urandom(200000)
+
+@pytest.fixture(scope='module')
+def server(tmp_path_factory):
+    root = tmp_path_factory.mktemp('ftproot')
+    for update in ['v20220310', 'v20230328']:
+        os.makedirs(os.path.join(root, 'data', update))
+        with open(os.path.join(root, 'data', update, name), 'wb') as fp:
+            fp.write(content)
+    process, port = benchmark.start_server(str(root))
+    yield port
+    process.terminate()
+    process.join()
+
+def download(port, writedirectory, source=directory, sizes=None):
+    downloader = haduk.FTPDownloader('127.0.0.1', port, benchmark.username, benchmark.password, source, str(writedirectory), nworkers=1, sizes=sizes)
+    failed = downloader.run([name])
+    assert failed == []
+    with open(os.path.join(writedirectory, name), 'rb') as fp:
+        assert fp.read() == content
+    assert not os.path.exists(os.path.join(writedirectory, name + '.part'))
+    return downloader
+
+def test_download_and_verify(server, tmp_path):
+    downloader = download(server, tmp_path)
+    assert downloader.downloaded == [name] and downloader.nbytes == len(content)
+    with open(os.path.join(tmp_path, '.hadukgrid_manifest.json')) as fp:
+        assert json.load(fp)[name] == {'size': len(content), 'directory': directory}
+    # Second run: verified with the size of the catalog, nothing transferred
+    downloader = download(server, tmp_path, sizes={name: len(content)})
+    assert downloader.verified == [name] and downloader.nbytes == 0
+
+@pytest.mark.parametrize('sizes', [None, {name: len(content)}])
+def test_resume_partial_file(server, tmp_path, sizes):
+    with open(os.path.join(tmp_path, name + '.part'), 'wb') as fp:
+        fp.write(content[:75000])
+    downloader = download(server, tmp_path, sizes=sizes)
+    assert downloader.downloaded == [name] and downloader.nbytes == len(content) - 75000
+
+def test_reject_size_mismatch(server, tmp_path):
+    # Cached copy larger than the file of the server (recorded with another size)
+    with open(os.path.join(tmp_path, name), 'wb') as fp:
+        fp.write(content + b'corrupted')
+    with open(os.path.join(tmp_path, '.hadukgrid_manifest.json'), 'w') as fp:
+        json.dump({name: {'size': len(content) + 9, 'directory': directory}}, fp)
+    downloader = download(server, tmp_path, sizes={name: len(content)})
+    assert downloader.downloaded == [name] and downloader.nbytes == len(content)
+
+def test_reject_other_directory(server, tmp_path):
+    # Same name and size, but downloaded from a previous update of the dataset
+    download(server, tmp_path)
+    downloader = haduk.FTPDownloader('127.0.0.1', server, benchmark.username, benchmark.password, 'data/v20230328', str(tmp_path), sizes={name: len(content)})
+    assert not downloader.is_cached(name)
+    downloader = download(server, tmp_path, source='data/v20230328', sizes={name: len(content)})
+    assert downloader.downloaded == [name] and downloader.nbytes == len(content)
+    with open(os.path.join(tmp_path, '.hadukgrid_manifest.json')) as fp:
+        assert json.load(fp)[name]['directory'] == 'data/v20230328'
@@ -0,0 +1,73 @@
+# Values of extract_file served by the result cache: only the dates already read are
+# served, the ranges read one after the other are merged, and the cache is keyed by the
+# update of the dataset. The files are the synthetic files of benchmark_HadUKGrid.py.
+import os
+import sys
+from datetime import datetime
+import numpy as np
+import pytest
+
+pytest.importorskip('cf')
+pytest.importorskip('netCDF4')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import API_HadUKGrid_data as haduk
+import benchmark_HadUKGrid as benchmark
+
+resolution = '60km'
+name = 'rainfall_hadukgrid_uk_60km_mon_201901-201912.nc'
+
+@pytest.fixture(scope='module')
+def dataset(tmp_path_factory):
+    directory = tmp_path_factory.mktemp('data')
+    filename = str(directory / name)
+    benchmark.write_file(filename, resolution, benchmark.file_dates('mon', 2019)[1], seed=0)
+    x, y, lon, lat = benchmark.grid_coordinates(resolution)
+    clat, clon = lat[len(y)//2, len(x)//2], lon[len(y)//2, len(x)//2]
+    targets = [('p', 'point', [clat, clon]), ('b', 'box', [clat-1, clat+1, clon-1, clon+1])]
+    grid = haduk.GridIndex.load(str(directory), benchmark.version, resolution, filename)
+    return filename, haduk.TargetSet(targets, grid)
+
+def extract(dataset, cache, date1, date2):
+    filename, target_set = dataset
+    dates, values, timings = haduk.extract_file(filename, target_set, date1, date2, cache)
+    # Same dates and values as a reading of the file without cache
+    expected = haduk.extract_file(filename, target_set, date1, date2)
+    assert np.array_equal(dates, expected[0])
+    assert np.allclose(values, expected[1], equal_nan=True)
+    return dates, timings['cached']
+
+def test_shorter_range_from_cache(dataset, tmp_path):
+    cache = haduk.ResultCache(str(tmp_path), 1e8, benchmark.version, benchmark.update)
+    assert not extract(dataset, cache, datetime(2019, 1, 1), datetime(2019, 12, 31))[1]
+    dates, cached = extract(dataset, cache, datetime(2019, 3, 1), datetime(2019, 4, 30))
+    assert cached and len(dates) == 2
+    # Dates beyond the file: the last step of the file has been read
+    assert extract(dataset, cache, datetime(2019, 6, 1), datetime(2020, 6, 30))[1]
+
+def test_wider_range_read_again(dataset, tmp_path):
+    cache = haduk.ResultCache(str(tmp_path), 1e8, benchmark.version, benchmark.update)
+    assert not extract(dataset, cache, datetime(2019, 3, 1), datetime(2019, 4, 30))[1]
+    dates, cached = extract(dataset, cache, datetime(2019, 1, 1), datetime(2019, 6, 30))
+    assert not cached and len(dates) == 6
+    assert extract(dataset, cache, datetime(2019, 2, 1), datetime(2019, 5, 31))[1]
+
+def test_touching_ranges_merged(dataset, tmp_path):
+    cache = haduk.ResultCache(str(tmp_path), 1e8, benchmark.version, benchmark.update)
+    assert not extract(dataset, cache, datetime(2019, 1, 1), datetime(2019, 3, 31))[1]
+    assert not extract(dataset, cache, datetime(2019, 4, 1), datetime(2019, 12, 31))[1]
+    dates, cached = extract(dataset, cache, datetime(2019, 1, 1), datetime(2019, 12, 31))
+    assert cached and len(dates) == 12
+
+def test_separate_ranges_not_merged(dataset, tmp_path):
+    cache = haduk.ResultCache(str(tmp_path), 1e8, benchmark.version, benchmark.update)
+    assert not extract(dataset, cache, datetime(2019, 1, 1), datetime(2019, 2, 28))[1]
+    assert not extract(dataset, cache, datetime(2019, 6, 1), datetime(2019, 7, 31))[1]
+    # The months in between have not been read
+    assert not extract(dataset, cache, datetime(2019, 1, 1), datetime(2019, 7, 31))[1]
+    assert extract(dataset, cache, datetime(2019, 2, 1), datetime(2019, 6, 30))[1]
+
+def test_other_update_not_served(dataset, tmp_path):
+    cache = haduk.ResultCache(str(tmp_path), 1e8, benchmark.version, benchmark.update)
+    assert not extract(dataset, cache, datetime(2019, 1, 1), datetime(2019, 12, 31))[1]
+    cache = haduk.ResultCache(str(tmp_path), 1e8, benchmark.version, 'v20230328')
+    assert not extract(dataset, cache, datetime(2019, 1, 1), datetime(2019, 12, 31))[1]
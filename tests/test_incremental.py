@@ -0,0 +1,49 @@
+# Incremental mode (--incremental y) against a local FTP server serving the synthetic
+# dataset of benchmark_HadUKGrid.py: extending the date range of a previous run gives the
+# same output as a full run.
+import os
+import sys
+import filecmp
+import pytest
+
+pytest.importorskip('pyftpdlib')
+pytest.importorskip('cf')
+pytest.importorskip('netCDF4')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import API_HadUKGrid_data as haduk
+import benchmark_HadUKGrid as benchmark
+
+resolution = '60km'
+
+@pytest.fixture(scope='module')
+def server(tmp_path_factory):
+    root = tmp_path_factory.mktemp('ftproot')
+    benchmark.make_dataset(str(root), resolution, 'mon', [2018, 2019, 2020])
+    x, y, lon, lat = benchmark.grid_coordinates(resolution)
+    clat, clon = lat[len(y)//2, len(x)//2], lon[len(y)//2, len(x)//2]
+    batch = root / 'targets.csv'
+    batch.write_text('id,lat,lon,S,N,W,E\np,%f,%f,,,,\nb,,,%f,%f,%f,%f\n' % (clat, clon, clat-1, clat+1, clon-1, clon+1))
+    process, port = benchmark.start_server(str(root))
+    yield port, '%f,%f' % (clat, clon), str(batch)
+    process.terminate()
+    process.join()
+
+def run(port, directory, date1, date2, targets, *options):
+    argv = ['-u', benchmark.username, '-p', benchmark.password, '--server', '127.0.0.1:%d' % (port), 
+        '-v', benchmark.variable, '-s', resolution, '-t', 'mon', '-m', 'txt', '-i', date1, '-j', date2, 
+        '-w', os.path.join(directory, 'tmp'), '-o', os.path.join(directory, 'out'), '--cachedirectory', os.path.join(directory, 'cache')]
+    assert haduk.main(argv + targets + list(options)) == 0
+    return os.path.join(directory, 'out')
+
+@pytest.mark.parametrize('kind', ['point', 'batch'])
+def test_extended_range(server, tmp_path, kind):
+    port, point, batch = server
+    targets = ['-r', point] if kind == 'point' else ['-b', batch, '--table', 'long']
+    # The second run keeps the rows of 2018, processes again the file of 2019 (read up to
+    # June only) and adds the file of 2020
+    run(port, str(tmp_path / 'incremental'), '2018-01-01', '2019-06-30', targets, '--incremental', 'y')
+    incremental = run(port, str(tmp_path / 'incremental'), '2018-01-01', '2020-12-31', targets, '--incremental', 'y')
+    full = run(port, str(tmp_path / 'full'), '2018-01-01', '2020-12-31', targets)
+    names = [fi for fi in os.listdir(full) if fi.endswith('.csv')]
+    assert len(names) == 1
+    assert filecmp.cmp(os.path.join(incremental, names[0]), os.path.join(full, names[0]), shallow=False)